@@ -0,0 +1,255 @@
+import os, time
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pydub import AudioSegment
+from sqlalchemy import and_
+from sqlalchemy.dialects.postgresql import insert
+
+from automated import waveform
+from automated.db import sm, Song, SongAnalysis
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Length of the frames RMS is measured over, in seconds.
+FRAME = 0.05
+
+# Loudness is measured over blocks of this many frames, and blocks quieter
+# than the gates are left out, roughly like EBU R128.
+BLOCK_FRAMES = 8
+ABSOLUTE_GATE = -70
+RELATIVE_GATE = -10
+
+# Anything quieter than this is silence, in dBFS.
+SILENCE = -50
+
+# The fade out is smoothed over this many frames, and the suggested
+# min_end and end are where it drops this far below the song's loudness.
+SMOOTH_FRAMES = 20
+MIN_END_DROP = 6
+END_DROP = 20
+
+# edit_song doesn't allow later start points than this.
+MAX_START = 3
+
+# What the suggested gain brings songs to, in dBFS.
+TARGET_LOUDNESS = -18
+
+parser = ArgumentParser(prog="automated analyse", description="Analyse songs for cue points and loudness.")
+parser.add_argument("--song-path", default="songs", help="Song path")
+parser.add_argument("--waveform-path", default=waveform.WAVEFORM_PATH, help="Where to write waveform peaks")
+parser.add_argument(
+    "--workers", type=int, default=None,
+    help="Number of processes to analyse songs with",
+)
+parser.add_argument(
+    "--force", action="store_true",
+    help="Analyse every song, not just new and changed ones",
+)
+parser.add_argument(
+    "--apply", action="store_true",
+    help="Use the suggested cue points for songs whose cue points haven't been set by hand",
+)
+
+
+class AnalysisError(Exception):
+    pass
+
+
+def main(argv):
+    args = parser.parse_args(argv)
+    if numpy is None:
+        print("Analysis needs NumPy. Install it with: pip install automated[analysis]")
+        return
+    analyse_catalog(args.song_path, args.waveform_path, args.workers, args.force)
+    if args.apply:
+        db = sm()
+        try:
+            print("APPLIED SUGGESTIONS TO %s SONGS" % apply_suggestions(db))
+            db.commit()
+        finally:
+            db.close()
+
+
+def decode(path):
+    """Returns a file's samples mixed to mono, between -1 and 1, and its sample rate."""
+    segment = AudioSegment.from_file(path).set_channels(1)
+    samples = numpy.frombuffer(
+        segment.raw_data, dtype={1: numpy.int8, 2: numpy.int16, 4: numpy.int32}[segment.sample_width],
+    ).astype(numpy.float32) / float(2 ** (8 * segment.sample_width - 1))
+    return samples, segment.frame_rate
+
+
+def analyse_file(path):
+    return analyse_samples(*decode(path))
+
+
+def analyse_samples(samples, frame_rate):
+    """Work out suggested cue points, in seconds, and the loudness of a song."""
+    frame_size = int(frame_rate * FRAME)
+    frames = len(samples) // frame_size
+    if frames < BLOCK_FRAMES:
+        raise AnalysisError("too short")
+    power = numpy.mean(
+        numpy.square(samples[:frames * frame_size].reshape(frames, frame_size)), axis=1,
+    )
+    level = _db(power)
+
+    # Gated loudness over blocks of frames.
+    blocks = len(power) // BLOCK_FRAMES
+    block_power = power[:blocks * BLOCK_FRAMES].reshape(blocks, BLOCK_FRAMES).mean(axis=1)
+    gated = block_power[_db(block_power) > ABSOLUTE_GATE]
+    if len(gated) == 0:
+        raise AnalysisError("silent")
+    gated = gated[_db(gated) > _db(gated.mean()) + RELATIVE_GATE]
+    loudness = float(_db(gated.mean()))
+
+    audible = numpy.nonzero(level > SILENCE)[0]
+    if len(audible) == 0:
+        raise AnalysisError("silent")
+    start = min(audible[0] * FRAME, MAX_START)
+    max_end = (audible[-1] + 1) * FRAME
+
+    # Find where the fade out starts and ends from a smoothed level, so
+    # quiet moments in the middle of a song don't count.
+    smoothed = _db(numpy.convolve(power, numpy.ones(SMOOTH_FRAMES) / SMOOTH_FRAMES, mode="same"))
+    end = _last_above(smoothed, loudness - END_DROP, start, max_end)
+    min_end = _last_above(smoothed, loudness - MIN_END_DROP, start, end)
+
+    return {
+        "duration": len(samples) / float(frame_rate),
+        "start": start,
+        "end": end,
+        "min_end": min_end,
+        "max_end": max_end,
+        "loudness": loudness,
+        "gain": TARGET_LOUDNESS - loudness,
+    }
+
+
+def _db(power):
+    return 10 * numpy.log10(numpy.maximum(power, 1e-10))
+
+
+def _last_above(level, threshold, minimum, maximum):
+    frames = numpy.nonzero(level >= threshold)[0]
+    if len(frames) == 0:
+        return maximum
+    return max(min((frames[-1] + 1) * FRAME, maximum), minimum + FRAME)
+
+
+def _analyse(song_id, path, waveform_path):
+    # Decode once for both the analysis and the waveform.
+    try:
+        samples, frame_rate = decode(path)
+        waveform.build(song_id, samples, frame_rate, waveform_path)
+        return analyse_samples(samples, frame_rate)
+    except Exception as e:
+        print("COULDN'T ANALYSE %s: %s" % (path, e))
+        return None
+
+
+def analyse_catalog(song_path="songs", waveform_path=waveform.WAVEFORM_PATH, workers=None, force=False, batch_size=100):
+    """
+    Analyse every song which is new, whose file has changed since it was
+    last analysed or which has no waveform, in a process pool. Returns how
+    many were analysed.
+    """
+    started = time.time()
+    db = sm()
+    try:
+        analysed = {
+            song_id: (file_size, file_mtime) for song_id, file_size, file_mtime
+            in db.query(SongAnalysis.song_id, SongAnalysis.file_size, SongAnalysis.file_mtime)
+        }
+        pending = []
+        for song_id, filename in db.query(Song.id, Song.filename):
+            path = os.path.join(song_path, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                print("MISSING FILE FOR SONG #%s: %s" % (song_id, path))
+                continue
+            if (
+                force
+                or analysed.get(song_id) != (stat.st_size, stat.st_mtime)
+                or not os.path.exists(waveform.paths(song_id, waveform_path)[0])
+            ):
+                pending.append((song_id, path, stat.st_size, stat.st_mtime))
+        print("%s OF %s SONGS NEED ANALYSING" % (len(pending), len(analysed) + len(pending)))
+
+        done = 0
+        rows = []
+        with ProcessPoolExecutor(workers) as pool:
+            futures = {
+                pool.submit(_analyse, song_id, path, waveform_path): (song_id, size, mtime)
+                for song_id, path, size, mtime in pending
+            }
+            for future in as_completed(futures):
+                song_id, size, mtime = futures[future]
+                result = future.result()
+                if result is None:
+                    continue
+                rows.append(_row(song_id, size, mtime, result))
+                if len(rows) >= batch_size:
+                    done += _save(db, rows)
+                    rows = []
+                    print("ANALYSED %s/%s (%.1f SONGS/S)" % (done, len(pending), done / max(time.time() - started, 0.001)))
+        done += _save(db, rows)
+    finally:
+        db.close()
+    print("ANALYSED %s SONGS IN %.1f SECONDS" % (done, time.time() - started))
+    return done
+
+
+def _row(song_id, size, mtime, result):
+    row = {
+        "song_id": song_id,
+        "file_size": size,
+        "file_mtime": mtime,
+        "analysed_at": datetime.now(),
+        "loudness": result["loudness"],
+        "gain": result["gain"],
+    }
+    for field in ("duration", "start", "end", "min_end", "max_end"):
+        row[field] = timedelta(0, result[field])
+    return row
+
+
+def _save(db, rows):
+    if not rows:
+        return 0
+    statement = insert(SongAnalysis.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=["song_id"],
+        set_={field: statement.excluded[field] for field in rows[0] if field != "song_id"},
+    )
+    db.execute(statement, rows)
+    db.commit()
+    return len(rows)
+
+
+def apply_suggestions(db):
+    """
+    Use the suggested cue points for songs which still have the defaults
+    from when they were added: no start point, and min_end and max_end the
+    same as end. Returns how many songs were changed.
+    """
+    songs = Song.__table__
+    analysis = SongAnalysis.__table__
+    return db.execute(songs.update().where(and_(
+        songs.c.id == analysis.c.song_id,
+        songs.c.start == timedelta(0),
+        songs.c.min_end == songs.c.end,
+        songs.c.max_end == songs.c.end,
+    )).values(
+        start=analysis.c.start,
+        end=analysis.c.end,
+        min_end=analysis.c.min_end,
+        max_end=analysis.c.max_end,
+    )).rowcount
@@ -1,15 +1,33 @@
+import time
+
 from collections import defaultdict
-from flask import Flask, abort, redirect, render_template, request, url_for
+from flask import Flask, abort, g, redirect, render_template, request, url_for
 from sqlalchemy import and_
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
 from automated.db import Session
-from automated.views import automation, schedule, playlist, log
+from automated.views import automation, schedule, playlist, log, metrics
 
 app = Flask(__name__)
 
 
+@app.before_request
+def start_timer():
+    g.request_started = time.time()
+
+
+@app.after_request
+def record_request_time(response=None):
+    metrics.request_seconds.observe(
+        time.time() - g.request_started,
+        route=request.endpoint,
+        method=request.method,
+        status=response.status_code,
+    )
+    return response
+
+
 @app.after_request
 def shutdown_session(response=None):
     Session.commit()
@@ -25,6 +43,7 @@ def shutdown_session(exception=None):
 
 app.add_url_rule("/", "automation", automation.automation, methods=("GET",))
 app.add_url_rule("/update", "automation_update", automation.update, methods=("GET",))
+app.add_url_rule("/stream", "automation_stream", automation.stream, methods=("GET",))
 
 # Schedule
 
@@ -51,8 +70,15 @@ app.add_url_rule("/playlist/categories/new", "new_category", playlist.new_catego
 app.add_url_rule("/playlist/categories/<int:category_id>", "playlist", playlist.playlist, methods=("GET",))
 app.add_url_rule("/playlist/songs/new", "new_song", playlist.new_song, methods=("POST",))
 app.add_url_rule("/playlist/songs/<int:song_id>", "song", playlist.song, methods=("GET",))
+app.add_url_rule("/playlist/songs/<int:song_id>/waveform", "song_waveform", playlist.song_waveform, methods=("GET",))
+app.add_url_rule("/playlist/songs/<int:song_id>/waveform/<int:level>", "song_waveform_level", playlist.song_waveform_level, methods=("GET",))
 app.add_url_rule("/playlist/songs/<int:song_id>/edit", "edit_song", playlist.edit_song, methods=("POST",))
 
 # Log
 
 app.add_url_rule("/log", "log", log.log, methods=("GET",))
+app.add_url_rule("/log/export", "log_export", log.export, methods=("GET",))
+
+# Metrics
+
+app.add_url_rule("/metrics", "metrics", metrics.metrics, methods=("GET",))
@@ -1,14 +1,22 @@
 import asyncio
 import aioredis
+import heapq
 import os
 import time
 
+from aioredis.pubsub import Receiver
+
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+from automated import metrics, rollups
+from automated.helpers.args import args
+from automated.helpers import plan, play, snapshot
 from automated.helpers.plan import generate_plan, PastTargetTime
-from automated.helpers.play import play_item, stop_item, queue_song, queue_stop, queue_event_start, queue_event_item, queue_event_end
-from automated.helpers.schedule import get_stream, get_default_sequence, find_event, populate_sequence_items, pick_song, start_event
+from automated.helpers.play import play_log, players, prepare_item, play_item, stop_item, cut_queue, queue_song, queue_stop, queue_event_start, queue_event_item, queue_event_end, prune_last_played
+from automated.helpers.calendar import event_signature
+from automated.helpers.state import Checkpoints, SchedulerState
+from automated.helpers.schedule import calendar, get_stream, get_default_sequence, find_event, find_events, populate_sequence_items, pick_song, start_event, clear_exclusions, SONG_LAST_PLAYED, ARTIST_LAST_PLAYED
 
 
 loop = asyncio.get_event_loop()
@@ -16,6 +24,55 @@ redis = loop.run_until_complete(aioredis.create_redis(("127.0.0.1", 6379), encod
 
 executor = ThreadPoolExecutor()
 
+play_queue_depth = metrics.Gauge("automated_play_queue_depth", "Number of upcoming items in the play queue.")
+lookahead_seconds = metrics.Gauge("automated_lookahead_seconds", "How far ahead the scheduler has planned.")
+executor_queue_length = metrics.Gauge("automated_executor_queue_length", "Number of tasks waiting for a thread pool.")
+
+# How often to publish metrics for the web app to re-export.
+METRICS_INTERVAL = 15
+
+# Items are cued up this many seconds before their start time.
+CUE_AHEAD = 10
+
+# How often to reload the play queue in case we missed a notification.
+RESYNC_INTERVAL = 60
+
+# How often to rebuild the play rollups for the hours which have finished.
+ROLLUP_INTERVAL = 3600
+
+# When an event changes, re-plan from this many seconds before it so the
+# planner has room to fit the gap.
+REPLAN_MARGIN = 900
+
+# Never re-plan items starting sooner than this, because they may already
+# have been cued up.
+REPLAN_AHEAD = 30
+
+# Hash of the scheduler's state and the last item it had queued, so it can
+# carry on after a restart.
+SCHEDULER_STATE = "scheduler_state:" + args.stream
+
+# Cached copy of the running flag, kept up to date by listen().
+running = False
+
+# Heap of (queue time, item ID) for items which haven't been cued up yet.
+upcoming = []
+upcoming_changed = asyncio.Event()
+
+# Set when the web app changes events, sequences or limits.
+schedule_changed = asyncio.Event()
+
+# Times the queue has been asked to be re-planned from.
+replan_times = []
+
+# Copies of the scheduler state after each step, to re-plan from.
+checkpoints = Checkpoints()
+
+# IDs of upcoming items which have been sent to the player pool.
+prepared = set()
+
+receiver = Receiver()
+
 
 async def setup():
     await redis.set("automation_pid", os.getpid())
@@ -26,145 +83,362 @@ async def setup():
     if await redis.get("artist_limit") is None:
         await redis.set("artist_limit", 3600)
 
-    # Make sure any existing future items are cleared.
-    future_items = await redis.zrangebyscore("play_queue", time.time(), float("inf"))
-    for item_id in future_items:
-        await redis.zrem("play_queue", item_id)
-        await redis.delete("item:"+item_id)
+    # Carry on from where we left off if we can.
+    state = await resume()
+
+    if state is None:
+
+        # Make sure any existing future items are cleared, and point the last
+        # played times for their songs back at the items which are left.
+        longest_limit = max(float(await redis.get("song_limit")), float(await redis.get("artist_limit")))
+        await cut_queue(datetime.now(), longest_limit)
+
+        # Anything still in the future doesn't have an item any more.
+        await prune_last_played(SONG_LAST_PLAYED, max_timestamp=time.time())
+        await prune_last_played(ARTIST_LAST_PLAYED, max_timestamp=time.time())
+
+    await snapshot.rebuild()
 
     await redis.set("running", "True")
 
+    return state
+
+
+async def resume():
+    """
+    Returns the scheduler state saved by the last run, if the play queue is
+    still the one it was planning.
+    """
+    saved = await redis.hgetall(SCHEDULER_STATE)
+    if not saved:
+        return None
+
+    # The last item queued when the state was saved has to still be there
+    # at the same time, and the queue mustn't have run out since.
+    last_score = float(saved.get("last_score", "nan"))
+    if await redis.zscore("play_queue", saved["last_item"]) != last_score or not await redis.exists("item:" + saved["last_item"]):
+        print("SAVED STATE DOESN'T MATCH THE PLAY QUEUE, STARTING AGAIN")
+        return None
+    try:
+        state = await loop.run_in_executor(executor, SchedulerState.from_json, saved["state"])
+    except ValueError as e:
+        print("CAN'T RESUME:", e)
+        return None
+    # Markers can be queued at exactly next_time, but nothing later.
+    if last_score > state.next_time.timestamp() or state.next_time < datetime.now() + timedelta(0, CUE_AHEAD):
+        print("SAVED STATE DOESN'T MATCH THE PLAY QUEUE, STARTING AGAIN")
+        return None
+
+    # Anything queued after the saved item is from a step which didn't
+    # finish. Items at next_time which were queued before it are kept.
+    longest_limit = max(float(await redis.get("song_limit")), float(await redis.get("artist_limit")))
+    await cut_queue(state.next_time, longest_limit, after=int(saved["last_number"]))
+    play.last_queued = (int(saved["last_number"]), saved["last_item"], last_score)
+
+    # Check for anything which changed while we weren't running. This keeps
+    # our place in the sequence unless the sequence itself was swapped.
+    schedule_changed.set()
+
+    print("RESUMING FROM", state.next_time)
+    return state
+
+
+async def save_state(state):
+    if play.last_queued is not None:
+        number, item_id, timestamp = play.last_queued
+        await redis.hmset_dict(
+            SCHEDULER_STATE, state=state.to_json(),
+            last_item=item_id, last_score=repr(timestamp), last_number=number,
+        )
+
+
+async def subscribe():
+    # Subscriptions need their own connection.
+    subscriber = await aioredis.create_redis(("127.0.0.1", 6379), encoding="utf-8")
+    await subscriber.subscribe(
+        receiver.channel("queue"), receiver.channel("running"), receiver.channel("schedule"),
+    )
+    # This only works if keyspace notifications are turned on, but it means
+    # we'll also notice if the running flag is changed by something else.
+    await subscriber.subscribe(receiver.channel("__keyspace@0__:running"))
+
+
+async def listen():
+    global running
+    async for channel, message in receiver.iter(encoding="utf-8"):
+        if channel.name == b"queue":
+            queue_time, item_id = message.split(" ", 1)
+            heapq.heappush(upcoming, (float(queue_time), item_id))
+        elif channel.name == b"schedule":
+            calendar.invalidate()
+            # A timestamp means re-plan from then, anything else is just a
+            # change.
+            try:
+                replan_times.append(datetime.fromtimestamp(float(message)))
+            except ValueError:
+                pass
+            schedule_changed.set()
+            continue
+        elif channel.name == b"running":
+            running = message == "True"
+        else:
+            running = message not in ("del", "expired")
+        if not running:
+            # Wake the scheduler up so it notices.
+            schedule_changed.set()
+        upcoming_changed.set()
+
+
+async def load_upcoming():
+    upcoming[:] = [
+        (queue_time, item_id) for item_id, queue_time in
+        await redis.zrangebyscore("play_queue", time.time() - 1, float("inf"), withscores=True)
+    ]
+    heapq.heapify(upcoming)
+
 
 async def play_queue():
-    while await redis.get("running") is not None:
-        t = time.time()
-        # Cue things up 10 seconds ahead.
-        play_items = await redis.zrangebyscore("play_queue", t - 1, t + 10, withscores=True)
-        for item_id, queue_time in play_items:
-            item = await redis.hgetall("item:" + item_id)
-            if len(item) == 0:
-                await redis.zrem("play_queue", item_id, item)
-                continue
-            if item["status"] != "queued":
+    await load_upcoming()
+    last_sync = time.time()
+
+    while running:
+
+        upcoming_changed.clear()
+
+        # Cue up everything which starts in the next 10 seconds.
+        while upcoming and upcoming[0][0] <= time.time() + CUE_AHEAD:
+            queue_time, item_id = heapq.heappop(upcoming)
+            prepared.discard(item_id)
+            # Skip anything we've missed.
+            if queue_time >= time.time() - 1:
+                await cue_item(queue_time, item_id)
+
+        # Open the files for anything a bit further ahead, so they're ready.
+        next_prepare = None
+        for queue_time, item_id in sorted(upcoming):
+            if item_id in prepared:
                 continue
-            await redis.hset("item:" + item_id, "status", "preparing")
-            if item["type"] != "stop":
-                loop.create_task(play_item(queue_time, item_id, item))
-            elif item["type"] == "event_start":
-                executor.submit(start_event, item["event_id"])
-            elif item["type"] == "event_end":
-                pass
-            else:
-                loop.create_task(stop_item(queue_time, item_id, item))
-        await asyncio.sleep(0.01)
+            if queue_time > time.time() + args.prepare_ahead:
+                next_prepare = queue_time - args.prepare_ahead
+                break
+            # Stop when the pool is full, and try again shortly. It has room
+            # again once a cued item takes its player.
+            if not await prepare_item(queue_time, item_id):
+                next_prepare = time.time() + 1
+                break
+            prepared.add(item_id)
+        players.cleanup()
+
+        if time.time() - last_sync >= RESYNC_INTERVAL:
+            await load_upcoming()
+            last_sync = time.time()
+            continue
+
+        # Then sleep until the next item is due, or the queue changes.
+        timeout = last_sync + RESYNC_INTERVAL - time.time()
+        if upcoming:
+            timeout = min(timeout, upcoming[0][0] - CUE_AHEAD - time.time())
+        if next_prepare is not None:
+            timeout = min(timeout, next_prepare - time.time())
+        try:
+            await asyncio.wait_for(upcoming_changed.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+
+async def publish_metrics():
+    while running:
+        play_queue_depth.set(len(upcoming))
+        for name, pool in (
+            ("automation", executor),
+            ("plan", plan.executor),
+            ("play", play.executor),
+        ):
+            executor_queue_length.set(pool._work_queue.qsize(), executor=name)
+        await redis.set("metrics:automation", metrics.registry.render(), expire=METRICS_INTERVAL * 4)
+        await asyncio.sleep(METRICS_INTERVAL)
+
 
+async def update_rollups():
+    while running:
+        try:
+            hours = await loop.run_in_executor(executor, rollups.catch_up)
+            if hours:
+                print("REBUILT ROLLUPS FOR %s HOURS" % hours)
+        except Exception as e:
+            print("COULDN'T UPDATE ROLLUPS:", e)
+        await asyncio.sleep(ROLLUP_INTERVAL)
 
-async def scheduler():
 
-    next_time           = datetime.now() + timedelta(0, 5)
-    current_event       = None
-    current_event_items = []
-    next_event          = None
-    stream              = await loop.run_in_executor(executor, get_stream)
-    sequence            = await loop.run_in_executor(executor, get_default_sequence)
-    sequence_items      = await loop.run_in_executor(executor, populate_sequence_items, sequence)
+async def cue_item(queue_time, item_id):
+    item = await redis.hgetall("item:" + item_id)
+    if len(item) == 0:
+        await redis.zrem("play_queue", item_id)
+        return
+    if item["status"] != "queued":
+        return
+    await redis.hset("item:" + item_id, "status", "preparing")
+    if item["type"] == "stop":
+        loop.create_task(stop_item(queue_time, item_id, item))
+    elif item["type"] == "event_start":
+        executor.submit(start_event, item["event_id"])
+    elif item["type"] == "event_end":
+        pass
+    else:
+        loop.create_task(play_item(queue_time, item_id, item))
+
+
+def lookahead(current_event, next_event):
+    # Keep the queue short around events so changes take effect quickly, and
+    # plan further ahead when there's nothing coming up.
+    if current_event or next_event:
+        return args.lookahead_min
+    return args.lookahead_max
+
+
+async def wait_until_needed(next_time, horizon):
+    """
+    Wait until the queue has run down to the lookahead horizon. Returns True
+    if the schedule changed while we were waiting.
+    """
+    if schedule_changed.is_set():
+        schedule_changed.clear()
+        return True
+    remaining = (next_time - datetime.now()).total_seconds() - horizon
+    if remaining <= 0:
+        return False
+    print("SLEEPING FOR UP TO %.0f SECONDS" % remaining)
+    try:
+        await asyncio.wait_for(schedule_changed.wait(), remaining)
+    except asyncio.TimeoutError:
+        return False
+    schedule_changed.clear()
+    return True
+
+
+async def scheduler(state=None):
+
+    stream = await loop.run_in_executor(executor, get_stream)
+    if state is None:
+        sequence = await loop.run_in_executor(executor, get_default_sequence)
+        state    = SchedulerState(
+            datetime.now() + timedelta(0, 5),
+            sequence,
+            await loop.run_in_executor(executor, populate_sequence_items, sequence),
+        )
+        state.last_queued = int(await redis.get("queue_number") or 0)
+    checkpoints.add(state)
 
     print("STREAM IS", stream)
 
-    while await redis.get("running") is not None:
+    while running:
+
+        if await wait_until_needed(state.next_time, lookahead(state.current_event, state.next_event)):
+            print("SCHEDULE CHANGED")
+            state = await schedule_change(state)
+            await save_state(state)
+            continue
 
         # Trim playlist items older than the longest repetition limit.
-        longest_limit = max(
-            float(await redis.get("song_limit")),
-            float(await redis.get("artist_limit")),
-        )
+        song_limit = float(await redis.get("song_limit"))
+        artist_limit = float(await redis.get("artist_limit"))
+        longest_limit = max(song_limit, artist_limit)
         old_items = await redis.zrangebyscore("play_queue", 0, time.time() - longest_limit)
         for item_id in old_items:
             await redis.zrem("play_queue", item_id)
             await redis.delete("item:" + item_id)
             await redis.delete("item:" + item_id + ":artists")
+        if old_items:
+            snapshot.refresh()
+
+        # The repetition limits are enforced using the last played times, so
+        # those only need trimming to their own limits.
+        await prune_last_played(SONG_LAST_PLAYED, min_timestamp=time.time() - song_limit)
+        await prune_last_played(ARTIST_LAST_PLAYED, min_timestamp=time.time() - artist_limit)
 
-        if current_event and current_event_items:
+        if state.current_event and state.current_event_items:
 
             print("PLANNING AHEAD FOR EVENT ITEM.")
 
             # Plan ahead for an event item
 
-            event_item = current_event_items.pop(0)
+            event_item = state.current_event_items.pop(0)
 
             try:
-                songs, sequence, sequence_items = await generate_plan(
-                    next_time,
+                songs, state.sequence, state.sequence_items = await generate_plan(
+                    state.next_time,
                     event_item,
-                    sequence,
-                    sequence_items,
-                    current_event.end_time if current_event else None,
+                    state.sequence,
+                    state.sequence_items,
+                    state.current_event.end_time if state.current_event else None,
                 )
                 for song, length in songs:
-                    await queue_song(next_time, song, length)
-                    next_time += length
+                    await queue_song(state.next_time, song, length)
+                    state.next_time += length
             except PastTargetTime:
                 print("EVENT TIME IN THE PAST, PLAYING IMMEDIATELY")
 
             # Play this event item...
             print("EVENT ITEM:", event_item)
-            await queue_event_item(next_time, event_item)
-            next_time += event_item.length
+            await queue_event_item(state.next_time, event_item)
+            state.next_time += event_item.length
 
             # ...and any following event items without a start time.
-            while current_event_items and not current_event_items[0].start_time:
-                event_item = current_event_items.pop(0)
+            while state.current_event_items and not state.current_event_items[0].start_time:
+                event_item = state.current_event_items.pop(0)
                 print("EVENT ITEM:", event_item)
-                await queue_event_item(next_time, event_item)
-                next_time += event_item.length
+                await queue_event_item(state.next_time, event_item)
+                state.next_time += event_item.length
 
-        elif next_event is not None:
+        elif state.next_event is not None:
 
             print("PLANNING AHEAD FOR EVENT.")
 
             # Plan ahead for an event
 
             try:
-                songs, sequence, sequence_items = await generate_plan(
-                    next_time,
-                    next_event,
-                    sequence,
-                    sequence_items,
-                    current_event.end_time if current_event else None,
+                songs, state.sequence, state.sequence_items = await generate_plan(
+                    state.next_time,
+                    state.next_event,
+                    state.sequence,
+                    state.sequence_items,
+                    state.current_event.end_time if state.current_event else None,
                 )
                 for song, length in songs:
-                    await queue_song(next_time, song, length)
-                    next_time += length
+                    await queue_song(state.next_time, song, length)
+                    state.next_time += length
             except PastTargetTime:
                 print("EVENT TIME IN THE PAST, PLAYING IMMEDIATELY")
 
-            if next_event.type == "stop":
-                await queue_stop(next_time, next_event)
+            state.planned_events[state.next_event.id] = (state.next_event.start_time, event_signature(state.next_event))
+
+            if state.next_event.type == "stop":
+                await queue_stop(state.next_time, state.next_event)
 
             else:
-                if current_event:
-                    await queue_event_end(next_time, current_event)
+                if state.current_event:
+                    await queue_event_end(state.next_time, state.current_event)
 
-                current_event, next_event = next_event, None
+                state.current_event, state.next_event = state.next_event, None
 
-                await queue_event_start(next_time, current_event)
+                await queue_event_start(state.next_time, state.current_event)
 
                 # Convert to a list so we can pop items without the ORM trying
                 # to update the database.
-                current_event_items = list(current_event.items)
+                state.current_event_items = list(state.current_event.items)
 
                 # Set current sequence based on the current event.
-                new_sequence = current_event.sequence or await loop.run_in_executor(executor, get_default_sequence)
-                if new_sequence.id != sequence.id:
-                    print("USING EVENT SEQUENCE:", current_event.sequence)
-                    sequence       = current_event.sequence
-                    sequence_items = await loop.run_in_executor(executor, populate_sequence_items, sequence)
-
-                while current_event_items and not current_event_items[0].start_time:
-                    event_item = current_event_items.pop(0)
+                new_sequence = state.current_event.sequence or await loop.run_in_executor(executor, get_default_sequence)
+                if new_sequence.id != state.sequence.id:
+                    print("USING EVENT SEQUENCE:", state.current_event.sequence)
+                    state.sequence       = state.current_event.sequence
+                    state.sequence_items = await loop.run_in_executor(executor, populate_sequence_items, state.sequence)
+
+                while state.current_event_items and not state.current_event_items[0].start_time:
+                    event_item = state.current_event_items.pop(0)
                     print("EVENT ITEM:", event_item)
-                    await queue_event_item(next_time, event_item)
-                    next_time += event_item.length
+                    await queue_event_item(state.next_time, event_item)
+                    state.next_time += event_item.length
 
         else:
 
@@ -172,69 +446,121 @@ async def scheduler():
 
             # Improvise
 
-            if sequence is None or len(sequence_items) == 0:
+            if state.sequence is None or len(state.sequence_items) == 0:
 
                 # If there isn't a sequence, just pick any song.
                 print("SEQUENCE IS NONE, PICKING ANY SONG.")
-                song = await loop.run_in_executor(executor, pick_song, next_time or datetime.now())
+                song = await loop.run_in_executor(executor, pick_song, state.next_time or datetime.now())
 
             else:
 
                 # Otherwise pick songs from the sequence.
-                print("CURRENT SEQUENCE IS", sequence)
-                item, category = sequence_items.pop(0)
+                print("CURRENT SEQUENCE IS", state.sequence)
+                item, category = state.sequence_items.pop(0)
                 print("ITEM", item)
                 print("CATEGORY", category)
-                song = await loop.run_in_executor(executor, pick_song, next_time or datetime.now(), category.id)
+                song = await loop.run_in_executor(executor, pick_song, state.next_time or datetime.now(), category.id)
 
             # Skip if we can't find a song.
             # This allows us to move on if one category in the sequence is
             # exhausted, although it risks putting us into an infinite loop
             # if there aren't enough songs in the other categories.
             if song is not None:
-                await queue_song(next_time, song)
-                next_time += song.length
+                await queue_song(state.next_time, song)
+                state.next_time += song.length
                 print("SELECTED", song)
             else:
                 print("NOTHING HERE, SKIPPING.")
 
-        # Pause if we've reached more than 30 minutes into the future.
-        while (
-            next_time - datetime.now() > timedelta(0, 1800)
-            and await redis.get("running") is not None
-        ):
-            await redis.publish("update", "update")
-            print("SLEEPING")
-            await asyncio.sleep(300)
+        lookahead_seconds.set((state.next_time - datetime.now()).total_seconds())
 
         # Reset the sequence if the current event is over.
         # If there's an explicit end time, wait until then.
         # Otherwise end when we run out of event items.
-        if current_event and (
-            (current_event.end_time and next_time > current_event.end_time)
-            or (not current_event.end_time and not current_event_items)
+        if state.current_event and (
+            (state.current_event.end_time and state.next_time > state.current_event.end_time)
+            or (not state.current_event.end_time and not state.current_event_items)
         ):
             print("EVENT OVER, RESETTING SEQUENCE")
-            await queue_event_end(next_time, current_event)
-            current_event  = None
-            sequence       = await loop.run_in_executor(executor, get_default_sequence)
-            sequence_items = await loop.run_in_executor(executor, populate_sequence_items, sequence)
+            await queue_event_end(state.next_time, state.current_event)
+            state.current_event  = None
+            state.sequence       = await loop.run_in_executor(executor, get_default_sequence)
+            state.sequence_items = await loop.run_in_executor(executor, populate_sequence_items, state.sequence)
 
         # Or just check if the item list needs repopulating.
-        elif len(sequence_items) == 0:
+        elif len(state.sequence_items) == 0:
             print("REPOPULATING SEQUENCE_ITEMS")
-            sequence_items = await loop.run_in_executor(executor, populate_sequence_items, sequence)
-
-        next_event = await loop.run_in_executor(executor, find_event, current_event, next_time)
+            state.sequence_items = await loop.run_in_executor(executor, populate_sequence_items, state.sequence)
+
+        state.next_event = await loop.run_in_executor(executor, find_event, state.current_event, state.next_time, args.lookahead_max)
+
+        if play.last_queued is not None:
+            state.last_queued = play.last_queued[0]
+        checkpoints.add(state)
+        checkpoints.trim(datetime.now())
+        state.forget_events(checkpoints.states[0].next_time)
+        await save_state(state)
+
+
+async def schedule_change(state):
+    """
+    Catch up with a change to the schedule. If events have been added,
+    moved or removed in the part of the queue which has already been
+    planned, the queue is cut shortly before the first of them and planning
+    carries on from the state it was in at that point.
+    """
+    clear_exclusions()
+    now = datetime.now()
+    cut_times = list(replan_times)
+    replan_times.clear()
+
+    events = await loop.run_in_executor(executor, find_events, now, state.next_time)
+    planned = {
+        event_id: planned for event_id, planned in state.planned_events.items()
+        if now < planned[0] <= state.next_time
+    }
+    # Events which have moved, been added or removed, or been edited.
+    changed = [
+        start_time for event_id, (start_time, signature) in list(events.items()) + list(planned.items())
+        if events.get(event_id) != planned.get(event_id)
+    ]
+    if changed:
+        cut_times.append(min(changed) - timedelta(0, REPLAN_MARGIN))
+
+    if cut_times:
+        restored = checkpoints.restore(min(cut_times), now + timedelta(0, REPLAN_AHEAD))
+        if restored is not None and restored.next_time < state.next_time:
+            longest_limit = max(float(await redis.get("song_limit")), float(await redis.get("artist_limit")))
+            removed = await cut_queue(restored.next_time, longest_limit, after=restored.last_queued)
+            print("REPLANNING FROM", restored.next_time, "REMOVED", len(removed), "ITEMS")
+            state = restored
+
+    # Pick up changes to the sequence, carrying on from the same place in
+    # it unless it's a different sequence.
+    sequence = state.sequence
+    if state.current_event is None:
+        sequence = await loop.run_in_executor(executor, get_default_sequence)
+    state.update_sequence(sequence, await loop.run_in_executor(executor, populate_sequence_items, sequence))
+    state.next_event = await loop.run_in_executor(executor, find_event, state.current_event, state.next_time, args.lookahead_max)
+    lookahead_seconds.set((state.next_time - datetime.now()).total_seconds())
+    return state
 
 
 try:
-    loop.run_until_complete(setup())
+    resumed_state = loop.run_until_complete(setup())
+    loop.run_until_complete(subscribe())
+    running = True
+    loop.create_task(listen())
     loop.create_task(play_queue())
-    loop.create_task(scheduler())
+    loop.create_task(publish_metrics())
+    loop.create_task(update_rollups())
+    loop.create_task(scheduler(resumed_state))
+    # Write anything left in the spool from last time.
+    play_log.start()
     loop.run_forever()
 except:
     loop.run_until_complete(redis.delete("running"))
+    loop.run_until_complete(play_log.flush())
     raise
 
 loop.run_until_complete(redis.delete("running"))
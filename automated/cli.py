@@ -0,0 +1,47 @@
+import importlib, sys
+
+
+USAGE = """usage: automated [run] STREAM [options]
+       automated import SOURCE [options]
+       automated analyse [options]
+       automated rollups
+
+Commands:
+  run      Run the automation daemon (the default)
+  import   Import songs from a directory or manifest
+  analyse  Suggest cue points and measure loudness for new and changed songs
+  rollups  Rebuild the play rollups up to the current hour
+"""
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv and argv[0] in ("-h", "--help"):
+        print(USAGE)
+        return
+
+    command = argv[0] if argv else None
+
+    if command == "import":
+        from automated import importer
+        importer.main(argv[1:])
+
+    elif command == "analyse":
+        from automated import analysis
+        analysis.main(argv[1:])
+
+    elif command == "rollups":
+        from automated import rollups
+        print("REBUILT %s HOURS" % rollups.catch_up())
+
+    else:
+        # The daemon reads its arguments from sys.argv when it's imported.
+        if command == "run":
+            argv = argv[1:]
+        sys.argv = [sys.argv[0]] + argv
+        importlib.import_module("automated.automation")
+
+
+if __name__ == "__main__":
+    main()
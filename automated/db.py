@@ -1,6 +1,5 @@
 import datetime
 import sys
-import time
 
 from contextlib import contextmanager
 from datetime import timedelta
@@ -12,8 +11,10 @@ from sqlalchemy import (
     Table,
     Column,
     Boolean,
+    Date,
     DateTime,
     Enum,
+    Float,
     ForeignKey,
     Integer,
     Interval,
@@ -92,6 +93,27 @@ class Song(Base):
         return "<Song #%s: %s>" % (self.id, self.name)
 
 
+class SongAnalysis(Base):
+    """Cue points and loudness worked out from a song's audio."""
+    __tablename__ = "song_analysis"
+    song_id = Column(Integer, ForeignKey("songs.id", ondelete="CASCADE"), primary_key=True)
+    # The file as it was analysed, so changed files can be found.
+    file_size = Column(Integer, nullable=False)
+    file_mtime = Column(Float, nullable=False)
+    analysed_at = Column(DateTime, nullable=False)
+    duration = Column(Interval, nullable=False)
+    start = Column(Interval, nullable=False)
+    end = Column(Interval, nullable=False)
+    min_end = Column(Interval, nullable=False)
+    max_end = Column(Interval, nullable=False)
+    # Gated RMS loudness in dBFS, and the gain in dB to bring it to the target.
+    loudness = Column(Float)
+    gain = Column(Float)
+
+    def __repr__(self):
+        return "<SongAnalysis #%s>" % self.song_id
+
+
 class Category(Base):
     __tablename__ = "categories"
     id = Column(Integer, primary_key=True)
@@ -208,6 +230,38 @@ class Play(Base):
     song_id = Column(Integer, ForeignKey("songs.id"), nullable=False)
 
 
+class HourlyPlays(Base):
+    """
+    Play counts and airtime per song, artist or category each hour. Plays
+    with no stream are counted under stream 0.
+    """
+    __tablename__ = "hourly_plays"
+    hour = Column(DateTime, primary_key=True)
+    stream_id = Column(Integer, primary_key=True)
+    dimension = Column(Enum("song", "artist", "category", name="rollup_dimension"), primary_key=True)
+    key_id = Column(Integer, primary_key=True)
+    plays = Column(Integer, nullable=False, default=0)
+    airtime = Column(Interval, nullable=False, default=timedelta(0))
+
+
+class DailyPlays(Base):
+    """The same as HourlyPlays, but per day."""
+    __tablename__ = "daily_plays"
+    day = Column(Date, primary_key=True)
+    stream_id = Column(Integer, primary_key=True)
+    dimension = Column(Enum("song", "artist", "category", name="rollup_dimension"), primary_key=True)
+    key_id = Column(Integer, primary_key=True)
+    plays = Column(Integer, nullable=False, default=0)
+    airtime = Column(Interval, nullable=False, default=timedelta(0))
+
+
+class RollupProgress(Base):
+    """How far the rollups have been rebuilt from the plays table."""
+    __tablename__ = "rollup_progress"
+    name = Column(Unicode(50), primary_key=True)
+    time = Column(DateTime, nullable=False)
+
+
 song_artists = Table(
     "song_artists", Base.metadata,
     Column("song_id", Integer, ForeignKey("songs.id"), primary_key=True),
@@ -219,6 +273,7 @@ Stream.default_sequence = relationship(Sequence)
 
 Song.category = relationship(Category, backref="songs")
 Song.artists = relationship("Artist", secondary=song_artists, backref="songs", order_by=Artist.name.asc())
+Song.analysis = relationship(SongAnalysis, uselist=False)
 
 Sequence.items = relationship(SequenceItem, backref="sequence", order_by=SequenceItem.number.asc())
 SequenceItem.category = relationship(Category)
@@ -233,6 +288,7 @@ Play.song = relationship(Song)
 
 
 Index("play_time", Play.time)
+Index("daily_plays_key", DailyPlays.dimension, DailyPlays.key_id, DailyPlays.day)
 
 
 def string_to_timedelta(input_string):
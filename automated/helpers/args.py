@@ -6,5 +6,67 @@ parser.add_argument("stream", help="Stream URL")
 parser.add_argument("--song-path", help="Song path")
 parser.add_argument("--audio-path", help="Audio event path")
 
+parser.add_argument(
+    "--envelope-rate", type=float, default=50,
+    help="How many times per second to update volume during fades",
+)
+
+parser.add_argument(
+    "--prepare-ahead", type=float, default=60,
+    help="How many seconds ahead to open files before they play",
+)
+parser.add_argument(
+    "--player-pool-size", type=int, default=4,
+    help="Maximum number of players to keep open ahead of time",
+)
+
+parser.add_argument(
+    "--snapshot-past", type=float, default=3600,
+    help="How many seconds of history to show in the web interface",
+)
+parser.add_argument(
+    "--snapshot-future", type=float, default=3600,
+    help="How many seconds of upcoming items to show in the web interface",
+)
+
+parser.add_argument(
+    "--planner", choices=("random", "exact", "parallel"), default="random",
+    help="How to fill the gap before an event: random attempts, an exact search or random attempts in a process pool",
+)
+parser.add_argument(
+    "--fit-policy", choices=("proportional", "water_filling", "prefer_last"), default="water_filling",
+    help="How to spread shortening or lengthening over the songs in a plan",
+)
+parser.add_argument(
+    "--plan-budget", type=float, default=5,
+    help="Seconds to spend on parallel plan attempts before using the best so far",
+)
+
+parser.add_argument(
+    "--lookahead-min", type=float, default=300,
+    help="Seconds to plan ahead when an event is on or coming up",
+)
+parser.add_argument(
+    "--lookahead-max", type=float, default=1800,
+    help="Seconds to plan ahead when there are no events coming up, which is also how far ahead to look for events",
+)
+parser.add_argument(
+    "--calendar-hours", type=float, default=6,
+    help="Hours of upcoming events to keep in memory",
+)
+
+parser.add_argument(
+    "--play-log-batch", type=int, default=50,
+    help="How many plays to write to the log at once",
+)
+parser.add_argument(
+    "--play-log-interval", type=float, default=5,
+    help="Maximum number of seconds to wait before writing plays to the log",
+)
+parser.add_argument(
+    "--play-log-spool", default="play_log.spool",
+    help="File to keep plays in while the database is unavailable. Plays the database rejects are written next to it, with .rejected on the end",
+)
+
 args = parser.parse_args()
 
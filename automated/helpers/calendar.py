@@ -0,0 +1,113 @@
+import bisect, hashlib, threading, time
+
+from datetime import timedelta
+from sqlalchemy.orm import selectinload, with_polymorphic
+
+from automated.db import session_scope, Event, EventItem, Song, Stream
+
+
+def event_query(db):
+    """
+    Query for events with everything the scheduler uses already loaded, so
+    they can be used after the session has gone.
+    """
+    events = with_polymorphic(Event, "*")
+    items = with_polymorphic(EventItem, "*")
+    return db.query(events).options(
+        selectinload(events.PlayEvent.sequence),
+        selectinload(events.items.of_type(items))
+            .selectinload(items.SongEventItem.song)
+            .selectinload(Song.artists),
+        selectinload(events.items.of_type(items))
+            .selectinload(items.SongEventItem.song)
+            .joinedload(Song.category),
+    )
+
+
+def event_signature(event):
+    """
+    Returns a short string which changes whenever anything the scheduler
+    plans around changes, so edits to an event's items, sequence or end
+    time can be spotted even when its start time stays the same.
+    """
+    fields = [
+        event.type, event.error_margin,
+        getattr(event, "sequence_id", None), getattr(event, "end_time", None),
+    ]
+    for item in event.items:
+        fields.append((
+            item.id, item.order, item.type, item.start_time, item.error_margin,
+            getattr(item, "song_id", None), getattr(item, "start", None), getattr(item, "end", None),
+        ))
+    return hashlib.sha1(repr(fields).encode("utf-8")).hexdigest()[:16]
+
+
+class EventCalendar(object):
+    """
+    In-memory index of a stream's upcoming events, so finding the next one
+    doesn't need a database round trip after every song. Events are loaded
+    for a window of time and kept in order of start time.
+    """
+
+    def __init__(self, stream, hours=6, max_age=300):
+        self.stream = stream
+        self.hours = hours
+        self.max_age = max_age
+        self.loaded_at = None
+        self.invalidated_at = 0
+        self.range_start = None
+        self.range_end = None
+        self.events = []
+        self.start_times = []
+        self._lock = threading.Lock()
+
+    def load(self, range_start, range_end=None):
+        # Load at least `hours` ahead, and further if the lookup needs it.
+        started = time.time()
+        range_end = max(range_end or range_start, range_start + timedelta(0, self.hours * 3600))
+        with session_scope() as db:
+            events = event_query(db).filter(
+                Event.stream_id == db.query(Stream.id).filter(Stream.url_name == self.stream),
+                Event.start_time > range_start,
+                Event.start_time <= range_end,
+            ).order_by(Event.start_time).all()
+        self.events = events
+        self.start_times = [event.start_time for event in events]
+        self.range_start, self.range_end = range_start, range_end
+        self.loaded_at = started
+        print("CALENDAR LOADED:", len(events), "EVENTS UNTIL", range_end)
+
+    def invalidate(self):
+        # Reload on the next lookup. Called when the schedule changes, which
+        # can be while a load is already under way.
+        self.invalidated_at = time.time()
+
+    def refresh(self, range_start, range_end):
+        # Reload if the calendar is older than max_age or doesn't cover the
+        # range, so changes show up eventually even if we miss a message.
+        # Callers hold the lock, so a lookup never sees half a load.
+        if (
+            self.loaded_at is None
+            or self.loaded_at <= self.invalidated_at
+            or time.time() - self.loaded_at >= self.max_age
+            or range_start < self.range_start
+            or range_end > self.range_end
+        ):
+            self.load(range_start, range_end)
+
+    def between(self, range_start, range_end):
+        """Returns the events starting after range_start, up to range_end."""
+        with self._lock:
+            self.refresh(range_start, range_end)
+            first = bisect.bisect_right(self.start_times, range_start)
+            last = bisect.bisect_right(self.start_times, range_end)
+            return self.events[first:last]
+
+    def next_event(self, after, range_end):
+        """Returns the first event starting after `after` and up to range_end."""
+        with self._lock:
+            self.refresh(after, range_end)
+            n = bisect.bisect_right(self.start_times, after)
+            if n < len(self.events) and self.start_times[n] <= range_end:
+                return self.events[n]
+            return None
@@ -0,0 +1,151 @@
+import hashlib, random, threading, time
+
+from sqlalchemy.orm import joinedload
+
+from automated.db import session_scope, Song
+
+
+def catalog_signature(all_songs):
+    """
+    Returns a short string which changes whenever anything planning or
+    queueing uses from the songs changes.
+    """
+    fields = [
+        (
+            song.id, song.name, song.filename, song.start, song.end, song.min_end, song.max_end,
+            song.category_id, song.category.name, sorted((_.id, _.name) for _ in song.artists),
+        )
+        for song in all_songs
+    ]
+    return hashlib.sha1(repr(fields).encode("utf-8")).hexdigest()[:16]
+
+
+class Catalog(object):
+    """
+    In-memory index of the song library, so picking a song doesn't need a
+    database round trip. Songs are detached from their session with their
+    artists and category already loaded.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.loaded_at = None
+        self.version = 0
+        self.signature = None
+        self.songs = {}
+        self.all_songs = []
+        self.categories = {}
+        self.song_artists = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled, so leave it out when sending the catalog
+        # to another process.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def load(self):
+        with session_scope() as db:
+            all_songs = db.query(Song).options(
+                joinedload(Song.artists),
+                joinedload(Song.category),
+            ).order_by(Song.id).all()
+
+        songs = {}
+        categories = {}
+        song_artists = {}
+        for song in all_songs:
+            songs[song.id] = song
+            categories.setdefault(song.category_id, []).append(song)
+            song_artists[song.id] = frozenset(_.id for _ in song.artists)
+
+        self.songs, self.all_songs, self.categories, self.song_artists = (
+            songs, all_songs, categories, song_artists,
+        )
+        self.loaded_at = time.time()
+        # Only count it as a new version if something actually changed, so
+        # copies in other processes aren't replaced after every reload.
+        signature = catalog_signature(all_songs)
+        if signature != self.signature:
+            self.signature = signature
+            self.version += 1
+        print("CATALOG LOADED:", len(all_songs), "SONGS")
+
+    def refresh(self):
+        # Reload if the catalog is older than max_age, so songs added or
+        # edited through the web interface show up eventually.
+        if self.loaded_at is not None and time.time() - self.loaded_at < self.max_age:
+            return
+        with self._lock:
+            if self.loaded_at is None or time.time() - self.loaded_at >= self.max_age:
+                self.load()
+
+    def eligible(self, category_id=None, songs=None, artists=None):
+        if category_id is not None:
+            candidates = self.categories.get(category_id, [])
+        else:
+            candidates = self.all_songs
+        song_artists = self.song_artists
+        return [
+            song for song in candidates
+            if (not songs or song.id not in songs)
+            and (not artists or song_artists[song.id].isdisjoint(artists))
+        ]
+
+    def pick(self, category_id=None, songs=None, artists=None, length=None, recent=None):
+        """
+        Pick a random song, optionally from a category, which isn't in
+        `songs` and doesn't share an artist with `artists`. If `length` is
+        given, prefer songs which can be shortened or lengthened to fit it.
+        `recent` is called with a few candidates at a time and returns the
+        IDs of any which were played too recently.
+        """
+
+        if category_id is not None:
+            candidates = self.categories.get(category_id, [])
+        else:
+            candidates = self.all_songs
+
+        song_artists = self.song_artists
+
+        def eligible(song):
+            return (
+                (not songs or song.id not in songs)
+                and (not artists or song_artists[song.id].isdisjoint(artists))
+            )
+
+        if length is not None:
+            length_song = _random_choice(candidates, lambda song: (
+                song.min_length <= length <= song.max_length and eligible(song)
+            ), recent)
+            if length_song is not None:
+                return length_song
+
+        return _random_choice(candidates, eligible, recent)
+
+
+def _batches(candidates):
+    # Most of the catalog is usually eligible, so a few random probes will
+    # normally find something. The shuffled scan is only built if they don't.
+    yield [random.choice(candidates) for n in range(min(len(candidates), 8))]
+    shuffled = random.sample(candidates, len(candidates))
+    for n in range(0, len(shuffled), 64):
+        yield shuffled[n:n + 64]
+
+
+def _random_choice(candidates, predicate, recent=None):
+    # Songs are checked against `recent` in batches, so it's one lookup for
+    # each batch rather than each song.
+    for batch in _batches(candidates):
+        batch = [song for song in batch if predicate(song)]
+        if batch and recent is not None:
+            excluded = recent(batch)
+            batch = [song for song in batch if song.id not in excluded]
+        if batch:
+            return batch[0]
+    return None
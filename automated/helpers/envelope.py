@@ -0,0 +1,114 @@
+import asyncio, time, vlc
+
+
+# How often to check whether a player has reached the end of its file.
+STATE_CHECK_INTERVAL = 0.5
+
+
+def volume_curve(keyframes):
+    """
+    Turn a list of (time, volume) keyframes into the list of times when the
+    integer volume changes, by interpolating linearly between them.
+    """
+    curve = [keyframes[0]]
+    for (start_time, start_volume), (end_time, end_volume) in zip(keyframes, keyframes[1:]):
+        steps = abs(end_volume - start_volume)
+        direction = 1 if end_volume > start_volume else -1
+        for step in range(1, steps):
+            curve.append((
+                start_time + (end_time - start_time) * step / steps,
+                start_volume + step * direction,
+            ))
+        curve.append((end_time, end_volume))
+    return curve
+
+
+class Envelope(object):
+
+    def __init__(self, mp, keyframes):
+        self.mp = mp
+        self.curve = volume_curve(keyframes)
+        self.position = 0
+        self.volume = None
+        # Timing information for telemetry: when the player first became
+        # audible, and the most any volume change was applied late by.
+        self.audible_at = None
+        self.max_slip = 0
+        self.next_state_check = time.time() + STATE_CHECK_INTERVAL
+        self.finished = asyncio.Future()
+
+    def tick(self, current_time):
+        # Move on to the latest point which is due.
+        position = self.position
+        while position < len(self.curve) and self.curve[position][0] <= current_time:
+            position += 1
+        if position != self.position:
+            self.position = position
+            point_time, volume = self.curve[position - 1]
+            # Only call into libvlc when the volume actually changes.
+            if volume != self.volume:
+                self.mp.audio_set_volume(volume)
+                self.volume = volume
+                self.max_slip = max(self.max_slip, current_time - point_time)
+                if volume > 0 and self.audible_at is None:
+                    self.audible_at = current_time
+
+        if self.position == len(self.curve):
+            return False
+
+        if current_time >= self.next_state_check:
+            self.next_state_check = current_time + STATE_CHECK_INTERVAL
+            if self.mp.get_state() == vlc.State.Ended:
+                return False
+
+        return True
+
+    @property
+    def next_change(self):
+        return min(self.curve[self.position][0], self.next_state_check)
+
+
+class EnvelopeEngine(object):
+    """
+    Applies volume envelopes to all the active players from one loop, rather
+    than having every player run its own.
+    """
+
+    def __init__(self, rate=50):
+        self.interval = 1.0 / rate
+        self.envelopes = set()
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def add(self, mp, keyframes):
+        """
+        Start applying the keyframes to a player. Returns a future which is
+        resolved with the Envelope when the last keyframe is reached or the
+        player ends.
+        """
+        envelope = Envelope(mp, keyframes)
+        self.envelopes.add(envelope)
+        self.changed.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return envelope.finished
+
+    async def run(self):
+        while self.envelopes:
+            self.changed.clear()
+            current_time = time.time()
+            for envelope in list(self.envelopes):
+                if not envelope.tick(current_time):
+                    self.envelopes.remove(envelope)
+                    envelope.finished.set_result(envelope)
+
+            if not self.envelopes:
+                break
+
+            # Sleep until something needs changing, but no less than one tick.
+            next_change = min(_.next_change for _ in self.envelopes)
+            timeout = max(next_change - time.time(), self.interval)
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,91 @@
+from datetime import timedelta
+
+
+class CannotFit(Exception): pass
+
+
+def fit(songs, change, error_margin, policy="water_filling"):
+    """
+    Change the lengths of `songs` (a list of [song, length] pairs) so that
+    their total changes by `change`, or at least gets within `error_margin`
+    of it. A negative change shortens the songs and a positive one
+    lengthens them, without going past their min_length or max_length.
+
+    Raises CannotFit, without changing anything, if the songs can't absorb
+    enough of the change.
+    """
+
+    if change == timedelta(0):
+        return songs
+
+    if change > timedelta(0):
+        rooms = [song.max_length - length for song, length in songs]
+    else:
+        rooms = [length - song.min_length for song, length in songs]
+    rooms = [max(room, timedelta(0)) for room in rooms]
+
+    needed = abs(change)
+    total_room = sum(rooms, timedelta(0))
+    if total_room < needed - error_margin:
+        raise CannotFit
+
+    needed = min(needed, total_room)
+    if needed == timedelta(0):
+        return songs
+
+    amounts = POLICIES[policy](rooms, needed)
+    for song, amount in zip(songs, amounts):
+        song[1] += amount if change > timedelta(0) else -amount
+
+    return songs
+
+
+def proportional(rooms, needed):
+    # Every song changes by the same fraction of its room.
+    total_room = sum(rooms, timedelta(0))
+    amounts = [room * (needed / total_room) for room in rooms]
+    return _fix_rounding(rooms, amounts, needed)
+
+
+def water_filling(rooms, needed):
+    # Every song changes by the same amount, unless it runs out of room. This
+    # is where the old one-second-at-a-time loop would end up.
+    amounts = [timedelta(0)] * len(rooms)
+    remaining = needed
+    order = sorted(range(len(rooms)), key=lambda n: rooms[n])
+    for position, n in enumerate(order):
+        share = remaining / (len(order) - position)
+        amounts[n] = min(rooms[n], share)
+        remaining -= amounts[n]
+    return _fix_rounding(rooms, amounts, needed)
+
+
+def prefer_last(rooms, needed):
+    # Take as much as possible from the last song, which is the one right
+    # before the target, then work backwards.
+    amounts = [timedelta(0)] * len(rooms)
+    remaining = needed
+    for n in range(len(rooms) - 1, -1, -1):
+        amounts[n] = min(rooms[n], remaining)
+        remaining -= amounts[n]
+    return amounts
+
+
+def _fix_rounding(rooms, amounts, needed):
+    # Timedeltas round to the nearest microsecond, so put any difference on
+    # whichever songs still have room.
+    remaining = needed - sum(amounts, timedelta(0))
+    for n in range(len(rooms) - 1, -1, -1):
+        if remaining == timedelta(0):
+            break
+        adjustment = max(min(remaining, rooms[n] - amounts[n]), -amounts[n])
+        amounts[n] += adjustment
+        remaining -= adjustment
+    return amounts
+
+
+POLICIES = {
+    "proportional": proportional,
+    "water_filling": water_filling,
+    "prefer_last": prefer_last,
+}
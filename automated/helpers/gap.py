@@ -0,0 +1,296 @@
+import math
+
+from datetime import timedelta
+from random import Random
+
+
+# How many songs choosing may try, over every total, before giving up.
+SEARCH_BUDGET = 20000
+
+
+def fill_gap(slots, candidates, target_length, error_margin, max_songs=500, seed=0):
+    """
+    Find a sequence of songs whose lengths can be adjusted to fill a gap.
+
+    `slots` is an iterator of category IDs, in the order the sequence would
+    play them, and `candidates` returns the eligible songs for a category
+    ID. Each song can be played at any length between its min_length and
+    max_length, so each one adds an interval of possible lengths. We work
+    out which totals (in whole seconds) are reachable after each slot, then
+    search back from the reachable totals to choose songs without repeating
+    a song or artist. Ties are broken by `seed`, so the same gap with the
+    same seed always gets the same songs.
+
+    Returns a tuple of ([song, length] pairs, number of slots used, distance
+    from the target length), or None if no songs could be chosen.
+    """
+
+    target = target_length.total_seconds()
+    margin = error_margin.total_seconds()
+    window_start = max(int(math.floor(target - margin)), 0)
+    window_end = int(math.ceil(target + margin))
+    random = Random(seed)
+
+    layers = [1]
+    groups = []
+    category_groups = {}
+    # The shortest and longest totals distinct songs could add up to, which
+    # is tighter than the reachable totals because those allow repeats.
+    category_lengths = {}
+    category_counts = {}
+    lowest = highest = 0
+    # (distance, slots used, total) for every total worth trying.
+    exact = []
+    closest = []
+
+    for slot in slots:
+
+        if len(groups) == max_songs:
+            break
+
+        # Group songs by their rounded length range, because songs with the
+        # same range reach the same totals. The order of the groups and the
+        # songs in them is the order they're tried in when choosing.
+        if slot not in category_groups:
+            slot_groups = {}
+            for song in sorted(candidates(slot), key=lambda _: _.id):
+                key = (
+                    int(round(song.min_length.total_seconds())),
+                    int(round(song.max_length.total_seconds())),
+                )
+                slot_groups.setdefault(key, []).append(song)
+            keys = sorted(slot_groups)
+            random.shuffle(keys)
+            for key in keys:
+                random.shuffle(slot_groups[key])
+            category_groups[slot] = {key: slot_groups[key] for key in keys}
+            category_lengths[slot] = (
+                sorted(lo for lo, hi in slot_groups for _ in slot_groups[(lo, hi)]),
+                sorted((hi for lo, hi in slot_groups for _ in slot_groups[(lo, hi)]), reverse=True),
+            )
+        slot_groups = category_groups[slot]
+
+        previous = layers[-1]
+        if slot_groups:
+            # Allow totals to overshoot by one song, so we can still find the
+            # closest plan if nothing fits.
+            limit = window_end + max(hi for lo, hi in slot_groups)
+            mask = (1 << (limit + 1)) - 1
+            reachable = 0
+            for lo, hi in slot_groups:
+                reachable |= _spread(previous << lo, hi - lo)
+            reachable &= mask
+
+            count = category_counts[slot] = category_counts.get(slot, 0) + 1
+            shortest, longest = category_lengths[slot]
+            if count > len(shortest):
+                # There aren't enough songs left for this slot.
+                break
+            lowest += shortest[count - 1]
+            highest += longest[count - 1]
+            reachable &= ((1 << (highest + 1)) - 1) & ~((1 << lowest) - 1)
+        else:
+            # Empty categories get skipped.
+            reachable = previous
+
+        layers.append(reachable)
+        groups.append(slot_groups)
+
+        # Keep going after the first exact total, because repeated songs or
+        # artists can rule it out and more slots might not.
+        in_window = [
+            total for total in range(window_start, window_end + 1) if reachable >> total & 1
+        ]
+        if in_window:
+            exact.extend(
+                (0, len(groups), total)
+                for total in sorted(in_window, key=lambda _: abs(_ - target))
+            )
+        # If nothing works out exactly, the nearest totals either side of the
+        # window might.
+        closest.extend(
+            (distance, total, len(groups)) for distance, total
+            in _closest(reachable, window_start, window_end)
+        )
+
+        # Stop when every reachable total is past the end of the window.
+        if not reachable & ((1 << (window_end + 1)) - 1):
+            break
+
+    # Try the exact totals with the fewest songs first, then the closest of
+    # the rest.
+    options = exact + [
+        (distance, slots_used, total) for distance, total, slots_used
+        in sorted(closest, key=lambda _: (abs(_[0]), _[2]))
+    ]
+    # Proving a total can't be reached without repeats can take a long
+    # search, so each total gets a share of the budget, and half of it is
+    # kept back for the ones which aren't exact.
+    budget = SEARCH_BUDGET // 2
+    for n, (distance, slots_used, total) in enumerate(options):
+        if n == len(exact):
+            budget += SEARCH_BUDGET // 2
+        if budget <= 0:
+            continue
+        share = [min(budget, SEARCH_BUDGET // 5)]
+        budget -= share[0]
+        songs = _choose(layers, groups, slots_used, total, share)
+        budget += share[0]
+        if songs:
+            break
+    else:
+        return None
+
+    # The totals were rounded to whole seconds, so spread the remainder over
+    # the songs to get as close to the target as they allow.
+    _adjust(songs, target_length - sum((_[1] for _ in songs), timedelta(0)))
+
+    return songs, slots_used, sum((_[1] for _ in songs), timedelta(0)) - target_length
+
+
+def _spread(bits, width):
+    # OR together bits << 0, bits << 1, ... bits << width, doubling the span
+    # each time.
+    span = 1
+    while span <= width:
+        step = min(span, width + 1 - span)
+        bits |= bits << step
+        span += step
+    return bits
+
+
+def _closest(reachable, window_start, window_end):
+    # Returns the signed distance from the window and the total for the
+    # nearest reachable totals below and above it.
+    candidates = []
+    below = reachable & ((1 << window_start) - 1)
+    if below:
+        total = below.bit_length() - 1
+        candidates.append((total - window_start, total))
+    above = reachable >> (window_end + 1)
+    if above:
+        total = window_end + 1 + ((above & -above).bit_length() - 1)
+        candidates.append((total - window_end, total))
+    return candidates
+
+
+def _choose(layers, groups, slots_used, total, budget):
+    """
+    Choose songs for the first `slots_used` slots adding up to `total`,
+    backtracking when a song or artist would be repeated. Returns None if
+    there's no way to do it, or the budget runs out first.
+    """
+
+    # Songs without artists count as their own artist, so every song uses
+    # up at least one. Each artist can only be used once, so the shortest
+    # and longest lengths of the songs each artist is on bound what the
+    # rest of the slots can add up to.
+    song_artists = {}
+    shortest = {}
+    longest = {}
+    for slot_groups in groups[:slots_used]:
+        for (lo, hi), group_songs in slot_groups.items():
+            for song in group_songs:
+                if song.id not in song_artists:
+                    song_artists[song.id] = frozenset(_.id for _ in song.artists) or frozenset([("song", song.id)])
+                for artist in song_artists[song.id]:
+                    shortest[artist] = min(shortest.get(artist, lo), lo)
+                    longest[artist] = max(longest.get(artist, hi), hi)
+    by_shortest = sorted(shortest, key=lambda _: shortest[_])
+    by_longest = sorted(longest, key=lambda _: -longest[_])
+
+    # Number of songs needed for the first n slots.
+    needed = [0]
+    for slot_groups in groups[:slots_used]:
+        needed.append(needed[-1] + (1 if slot_groups else 0))
+
+    def possible(count, total):
+        lowest = _sum_unused(by_shortest, shortest, used_artists, count)
+        if lowest is None or total < lowest:
+            return False
+        return total <= _sum_unused(by_longest, longest, used_artists, count)
+
+    songs = []
+    used_songs = set()
+    used_artists = set()
+    # (slot, total, songs used) which are known not to work, because the
+    # same songs can be used in a different order.
+    failed = set()
+
+    def search(n, total):
+
+        # Empty categories were skipped.
+        while n > 0 and not groups[n - 1]:
+            n -= 1
+        if n == 0:
+            return total == 0
+        if not possible(needed[n], total):
+            return False
+        state = (n, total, frozenset(used_songs))
+        if state in failed:
+            return False
+        previous = layers[n - 1]
+
+        for (lo, hi), group_songs in groups[n - 1].items():
+            start = max(total - hi, 0)
+            end = total - lo
+            if end < 0 or not previous >> start & ((1 << (end - start + 1)) - 1):
+                continue
+            for song in group_songs:
+                if budget[0] <= 0:
+                    return False
+                budget[0] -= 1
+                artists = song_artists[song.id]
+                if song.id in used_songs or not artists.isdisjoint(used_artists):
+                    continue
+                used_songs.add(song.id)
+                used_artists.update(artists)
+                # Keep the song as close to its normal length as possible.
+                nominal = int(round(song.length.total_seconds()))
+                for previous_total in sorted(
+                    (_ for _ in range(start, end + 1) if previous >> _ & 1),
+                    key=lambda _: (abs(total - _ - nominal), _),
+                ):
+                    songs.append([song, _clamp(timedelta(0, total - previous_total), song)])
+                    if search(n - 1, previous_total):
+                        return True
+                    songs.pop()
+                used_songs.discard(song.id)
+                used_artists.difference_update(artists)
+
+        if budget[0] > 0:
+            failed.add(state)
+        return False
+
+    if not search(slots_used, total):
+        return None
+    # Songs were chosen from the last slot back.
+    songs.reverse()
+    return songs
+
+
+def _sum_unused(artists, lengths, used_artists, count):
+    # Adds up the first `count` lengths of artists who haven't been used, or
+    # returns None if there aren't enough.
+    total = 0
+    for artist in artists:
+        if count == 0:
+            return total
+        if artist not in used_artists:
+            total += lengths[artist]
+            count -= 1
+    return total if count == 0 else None
+
+
+def _adjust(songs, distance):
+    for song in songs:
+        if distance > timedelta(0):
+            change = min(distance, song[0].max_length - song[1])
+        else:
+            change = max(distance, song[0].min_length - song[1])
+        song[1] += change
+        distance -= change
+
+
+def _clamp(length, song):
+    return min(max(length, song.min_length), song.max_length)
@@ -1,24 +1,48 @@
-import asyncio
+import asyncio, time
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import timedelta
 
+from automated.helpers.args import args
+from automated.helpers.fit import fit, CannotFit
+from automated.helpers.gap import fill_gap
 from automated.helpers.schedule import (
+    catalog,
     get_default_sequence,
+    get_exclusions,
     pick_song,
     populate_sequence_items,
 )
+from automated.metrics import Counter, Histogram
 
 TEN_MINUTES = timedelta(0, 600)
 
 loop = asyncio.get_event_loop()
 executor = ThreadPoolExecutor()
 
+# Parallel plan attempts run in a process pool, using a copy of the catalog
+# which is sent to each process when the pool starts.
+process_pool = None
+process_pool_version = None
+snapshot = None
+
+# Statistics from the most recent parallel plan.
+plan_stats = {}
+
+generate_plan_seconds = Histogram("automated_generate_plan_seconds", "Time taken to generate a plan.")
+plan_attempts = Counter("automated_plan_attempts_total", "Number of plan attempts made.")
+plan_wins = Counter("automated_plan_wins_total", "Number of plan attempts which could be fitted to the target.")
+
 
 class PastTargetTime(Exception): pass
 
 
 async def generate_plan(next_time, target_object, sequence, sequence_items, use_sequence_until=None):
+    with generate_plan_seconds.time(planner=args.planner):
+        return await _generate_plan(next_time, target_object, sequence, sequence_items, use_sequence_until)
+
+
+async def _generate_plan(next_time, target_object, sequence, sequence_items, use_sequence_until):
 
     print("TARGET:", target_object)
 
@@ -29,27 +53,41 @@ async def generate_plan(next_time, target_object, sequence, sequence_items, use_
     target_length = target_object.start_time - next_time
     print("TARGET LENGTH:", target_length)
 
-    # Start by making 10 attempts...
-    attempts, errors = await asyncio.wait([
-        plan_attempt(next_time, target_length, target_object.error_margin, sequence, sequence_items, use_sequence_until)
-        for n in range(10)
-    ])
-    candidates = [_.result() for _ in attempts]
-    # TODO do something with errors
-
-    # ...and if that didn't give us any good plans, try another 100.
-    if not any(attempt["can_shorten"] or attempt["can_lengthen"] for attempt in candidates):
-        attempts, errors = await asyncio.wait([
-            plan_attempt(next_time, target_length, target_object.error_margin, sequence, sequence_items, use_sequence_until)
-            for n in range(10)
-        ])
-        candidates += [_.result() for _ in attempts]
-        # TODO do something with errors
+    if args.planner == "exact":
+        plan = await loop.run_in_executor(
+            executor, exact_plan,
+            next_time, target_length, target_object.error_margin,
+            sequence, sequence_items, use_sequence_until,
+        )
+        plan_attempts.inc(planner="exact")
+        if plan is not None:
+            songs, sequence, sequence_items, distance = plan
+            for song in songs:
+                print(song)
+            print("EXACT PLAN DISTANCE:", distance)
+            if abs(distance) > target_object.error_margin:
+                print("NO PLAN CAN MEET THE TARGET TIME, USING THE CLOSEST.")
+            else:
+                plan_wins.inc(planner="exact")
+            return songs, sequence, sequence_items
+        print("EXACT PLAN FAILED, FALLING BACK TO RANDOM ATTEMPTS.")
+
+    if args.planner == "parallel":
+        candidates = await parallel_attempts(
+            next_time, target_length, target_object.error_margin,
+            sequence, sequence_items, use_sequence_until,
+        )
+    else:
+        candidates = await random_attempts(
+            next_time, target_length, target_object.error_margin,
+            sequence, sequence_items, use_sequence_until,
+        )
 
-    # Hopefully we should be able to find a successful plan in 10
-    # attempts. For the particularly hard ones we can try 100, but
-    # after that it's pretty unlikely that we can meet the target
-    # time, so we just give up at that point.
+    plan_attempts.inc(len(candidates), planner=args.planner)
+    plan_wins.inc(
+        len([_ for _ in candidates if _["can_shorten"] or _["can_lengthen"]]),
+        planner=args.planner,
+    )
 
     candidates.sort(key=lambda a: (
         0 if a["can_shorten"] or a["can_lengthen"] else 1,
@@ -127,14 +165,36 @@ async def generate_plan(next_time, target_object, sequence, sequence_items, use_
     return songs, plan["sequence"], plan["sequence_items"]
 
 
-async def plan_attempt(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until=None):
+async def random_attempts(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until=None):
 
-    min_target_length = target_length - error_margin
-    max_target_length = target_length + error_margin
+    # Start by making 10 attempts...
+    attempts, errors = await asyncio.wait([
+        plan_attempt(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until)
+        for n in range(10)
+    ])
+    candidates = [_.result() for _ in attempts]
+    # TODO do something with errors
+
+    # ...and if that didn't give us any good plans, try another 100.
+    if not any(attempt["can_shorten"] or attempt["can_lengthen"] for attempt in candidates):
+        attempts, errors = await asyncio.wait([
+            plan_attempt(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until)
+            for n in range(10)
+        ])
+        candidates += [_.result() for _ in attempts]
+        # TODO do something with errors
+
+    # Hopefully we should be able to find a successful plan in 10
+    # attempts. For the particularly hard ones we can try 100, but
+    # after that it's pretty unlikely that we can meet the target
+    # time, so we just give up at that point.
+
+    return candidates
+
+
+async def plan_attempt(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until=None):
 
     attempt_length = timedelta(0)
-    attempt_min_length = timedelta(0)
-    attempt_max_length = timedelta(0)
 
     # Clone this so we don't alter the original.
     sequence_items = list(sequence_items)
@@ -187,8 +247,6 @@ async def plan_attempt(next_time, target_length, error_margin, sequence, sequenc
         songs.append([song, song.length])
 
         attempt_length += song.length
-        attempt_min_length += song.min_length
-        attempt_max_length += song.max_length
 
         next_time += song.length
 
@@ -203,6 +261,18 @@ async def plan_attempt(next_time, target_length, error_margin, sequence, sequenc
             print("REPOPULATING SEQUENCE_ITEMS")
             sequence_items = await loop.run_in_executor(executor, populate_sequence_items, sequence)
 
+    return _attempt_result(songs, sequence, sequence_items, target_length, error_margin)
+
+
+def _attempt_result(songs, sequence, sequence_items, target_length, error_margin):
+
+    min_target_length = target_length - error_margin
+    max_target_length = target_length + error_margin
+
+    attempt_length = sum((_[0].length for _ in songs), timedelta(0))
+    attempt_min_length = sum((_[0].min_length for _ in songs), timedelta(0))
+    attempt_max_length = sum((_[0].max_length for _ in songs), timedelta(0))
+
     can_shorten = attempt_min_length <= max_target_length
     can_lengthen = attempt_max_length - songs[-1][0].max_length >= min_target_length
 
@@ -226,35 +296,242 @@ async def plan_attempt(next_time, target_length, error_margin, sequence, sequenc
     }
 
 
+def _init_snapshot(catalog_snapshot):
+    global snapshot
+    snapshot = catalog_snapshot
+
+
+def get_process_pool():
+    global process_pool, process_pool_version
+    # Start a new pool whenever the songs in the catalog have changed, so
+    # the processes get the new copy. Reloads which change nothing keep the
+    # pool.
+    if process_pool is None or process_pool_version != catalog.version:
+        if process_pool is not None:
+            process_pool.shutdown(wait=False)
+        process_pool = ProcessPoolExecutor(initializer=_init_snapshot, initargs=(catalog,))
+        process_pool_version = catalog.version
+    return process_pool
+
+
+async def parallel_attempts(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until=None):
+
+    started = time.time()
+
+    # Work out everything which needs the database or Redis up front, so
+    # the attempts only need the catalog.
+    await loop.run_in_executor(executor, catalog.refresh)
+    excluded_songs, excluded_artists = await loop.run_in_executor(
+        executor, get_exclusions, time.mktime(next_time.timetuple()),
+    )
+    full_sequence_items = await loop.run_in_executor(executor, populate_sequence_items, sequence)
+    if use_sequence_until:
+        default_sequence       = await loop.run_in_executor(executor, get_default_sequence)
+        default_sequence_items = await loop.run_in_executor(executor, populate_sequence_items, default_sequence)
+    else:
+        default_sequence, default_sequence_items = None, []
+
+    candidates = []
+    wins = 0
+    deadline = started + args.plan_budget
+    out_of_time = False
+
+    pool = get_process_pool()
+    pending = set(
+        asyncio.wrap_future(pool.submit(
+            attempt_plan,
+            next_time, target_length, error_margin,
+            sequence, sequence_items, full_sequence_items, use_sequence_until,
+            default_sequence, default_sequence_items,
+            excluded_songs, excluded_artists, deadline,
+        ))
+        for n in range(20)
+    )
+
+    try:
+        # Stop as soon as any attempt can be fitted to the target, or when we
+        # run out of time. Attempts which are still running give up at the
+        # deadline by themselves, so they don't hold on to the workers.
+        while pending and wins == 0:
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=max(deadline - time.time(), 0),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                print("PLANNING BUDGET USED UP.")
+                out_of_time = True
+                break
+            for attempt in done:
+                if attempt.exception() is not None:
+                    print("PLAN ATTEMPT FAILED:", repr(attempt.exception()))
+                    continue
+                candidate = attempt.result()
+                if candidate is None:
+                    continue
+                candidates.append(candidate)
+                if candidate["can_shorten"] or candidate["can_lengthen"]:
+                    wins += 1
+    finally:
+        for attempt in pending:
+            attempt.cancel()
+
+    plan_stats.update({
+        "attempts": len(candidates),
+        "wins": wins,
+        "elapsed": time.time() - started,
+    })
+    print("PLAN STATS:", plan_stats)
+
+    if not candidates and out_of_time:
+        # We still need a plan, but there's no time for more than one.
+        print("NO PARALLEL ATTEMPTS FINISHED IN TIME, FALLING BACK TO A SINGLE ATTEMPT.")
+        return [await plan_attempt(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until)]
+
+    if not candidates:
+        print("NO PARALLEL ATTEMPTS SUCCEEDED, FALLING BACK TO RANDOM ATTEMPTS.")
+        return await random_attempts(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until)
+
+    return candidates
+
+
+def attempt_plan(
+    next_time, target_length, error_margin,
+    sequence, sequence_items, full_sequence_items, use_sequence_until,
+    default_sequence, default_sequence_items,
+    excluded_songs, excluded_artists, deadline,
+):
+    # The same as plan_attempt, but this runs in the process pool and picks
+    # from the catalog snapshot, using the repetition limits as of the start
+    # of the plan. Returns None if it's still going at the deadline.
+
+    attempt_length = timedelta(0)
+
+    # Clone this so we don't alter the original.
+    sequence_items = list(sequence_items)
+
+    songs = []
+    attempt_songs = set(excluded_songs)
+    attempt_artists = set(excluded_artists)
+
+    continues = 0
+
+    while attempt_length < target_length:
+
+        # Cancel if we run out of songs.
+        if continues == 10:
+            break
+
+        if time.time() >= deadline:
+            return None
+
+        remaining_time = target_length - attempt_length
+
+        if sequence is None or len(sequence_items) == 0:
+            # If there isn't a sequence, just pick any song.
+            category_id = None
+        else:
+            # Otherwise pick songs from the sequence.
+            item, category = sequence_items.pop(0)
+            category_id = category.id
+
+        song = snapshot.pick(
+            category_id, attempt_songs, attempt_artists,
+            remaining_time if remaining_time <= TEN_MINUTES else None,
+        )
+
+        if song is None:
+            continues += 1
+            continue
+
+        continues = 0
+
+        songs.append([song, song.length])
+        attempt_songs.add(song.id)
+        attempt_artists.update(_.id for _ in song.artists)
+
+        attempt_length += song.length
+        next_time += song.length
+
+        # Reset the sequence if necessary.
+        if use_sequence_until and next_time > use_sequence_until:
+            sequence, full_sequence_items = default_sequence, default_sequence_items
+            sequence_items = list(full_sequence_items)
+            use_sequence_until = None
+
+        # Or just check if the item list needs repopulating.
+        elif len(sequence_items) == 0:
+            sequence_items = list(full_sequence_items)
+
+    return _attempt_result(songs, sequence, sequence_items, target_length, error_margin)
+
+
+def exact_plan(next_time, target_length, error_margin, sequence, sequence_items, use_sequence_until=None):
+
+    # Resetting the sequence part way through isn't supported here, so leave
+    # that to the random attempts.
+    if use_sequence_until and next_time + target_length > use_sequence_until:
+        return None
+
+    catalog.refresh()
+    excluded_songs, excluded_artists = get_exclusions(time.mktime(next_time.timetuple()))
+
+    full_sequence_items = populate_sequence_items(sequence)
+
+    def slots():
+        # Follow the sequence the same way plan_attempt does, or allow any
+        # song if there isn't one.
+        items = list(sequence_items)
+        while True:
+            if len(full_sequence_items) == 0:
+                yield None
+                continue
+            if len(items) == 0:
+                items = list(full_sequence_items)
+            item, category = items.pop(0)
+            yield category.id
+
+    result = fill_gap(
+        slots(),
+        lambda category_id: catalog.eligible(category_id, excluded_songs, excluded_artists),
+        target_length,
+        error_margin,
+        # The same gap gets the same songs, but different gaps vary.
+        seed=int(time.mktime(next_time.timetuple())),
+    )
+    if result is None:
+        return None
+
+    songs, slots_used, distance = result
+
+    # Move the sequence on by the number of slots we used.
+    remaining_items = list(sequence_items)
+    if len(full_sequence_items) != 0:
+        for n in range(slots_used):
+            if len(remaining_items) == 0:
+                remaining_items = list(full_sequence_items)
+            remaining_items.pop(0)
+        if len(remaining_items) == 0:
+            remaining_items = list(full_sequence_items)
+
+    return songs, sequence, remaining_items, distance
+
+
 def shorten(songs, distance, error_margin):
-    while distance > error_margin:
+    try:
+        return fit(songs, -distance, error_margin, args.fit_policy)
+    except CannotFit:
+        print("CAN'T SHORTEN ENOUGH, USING MINIMUM LENGTHS.")
         for song in songs:
-            # Shorten each item by whichever is smallest:
-            # - distance remaining
-            # - song shortenability
-            # - one second
-            shorten_by = min(
-                distance,
-                song[1] - song[0].min_length,
-                timedelta(0, 1),
-            )
-            song[1] -= shorten_by
-            distance -= shorten_by
-    return songs
+            song[1] = song[0].min_length
+        return songs
 
 
 def lengthen(songs, distance, error_margin):
-    while distance > error_margin:
+    try:
+        return fit(songs, distance, error_margin, args.fit_policy)
+    except CannotFit:
+        print("CAN'T LENGTHEN ENOUGH, USING MAXIMUM LENGTHS.")
         for song in songs:
-            # Lengthen each item by whichever is smallest:
-            # - distance remaining
-            # - song lengthenability
-            # - one second
-            lengthen_by = min(
-                distance,
-                song[0].max_length - song[1],
-                timedelta(0, 1),
-            )
-            song[1] += lengthen_by
-            distance -= lengthen_by
-    return songs
+            song[1] = song[0].max_length
+        return songs
@@ -1,11 +1,15 @@
-import asyncio, aioredis, subprocess, time, vlc
+import asyncio, aioredis, subprocess, time
 
 from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timedelta
 from uuid import uuid4
 
-from automated.db import sm, Play, Stream
+from automated import timing
 from automated.helpers.args import args
+from automated.helpers.envelope import EnvelopeEngine
+from automated.helpers.players import PlayerPool
+from automated.helpers.playlog import PlayLog
+from automated.helpers import snapshot
+from automated.helpers.schedule import SONG_LAST_PLAYED, ARTIST_LAST_PLAYED, clear_exclusions
 
 
 loop = asyncio.get_event_loop()
@@ -13,6 +17,18 @@ redis = loop.run_until_complete(aioredis.create_redis(("127.0.0.1", 6379), encod
 
 executor = ThreadPoolExecutor()
 
+envelopes = EnvelopeEngine(args.envelope_rate)
+
+players = PlayerPool(args.player_pool_size)
+
+play_log = PlayLog(args.stream, args.play_log_spool, args.play_log_batch, args.play_log_interval)
+
+
+# (number, item ID, timestamp) of the last item this process queued. Items
+# are numbered in the order they're queued, so a cut can keep the items at
+# the cut time which were queued before it.
+last_queued = None
+
 
 PATHS = {
     "song": (args.song_path or "songs") + "/",
@@ -20,6 +36,20 @@ PATHS = {
 }
 
 
+async def prepare_item(queue_time, item_id):
+    """
+    Open the file for an item ahead of time. Returns False if the player pool
+    is full, so it can be tried again later.
+    """
+    item = await redis.hgetall("item:" + item_id)
+    if item.get("status") == "queued" and item["type"] in PATHS:
+        # Give up on it if it hasn't been played a minute after it should
+        # have started.
+        return players.prepare(item_id, PATHS[item["type"]] + item["filename"], queue_time + 60)
+    # Nothing to open.
+    return True
+
+
 async def play_item(queue_time, item_id, item):
     keyframes = []
     if float(item["start"]) >= 2:
@@ -30,13 +60,10 @@ async def play_item(queue_time, item_id, item):
         (queue_time + float(item["length"]) + 5, 0),
     ]
 
-    mp = vlc.MediaPlayer(PATHS[item["type"]] + item["filename"])
-
-    mp.audio_set_volume(0)
-    mp.play()
-    while mp.get_state() in (vlc.State.NothingSpecial, vlc.State.Opening, vlc.State.Buffering):
-        await asyncio.sleep(0.01)
-    mp.pause()
+    # Use the player prepared earlier if there is one.
+    mp = await players.take(item_id)
+    if mp is None:
+        mp = await players.open(PATHS[item["type"]] + item["filename"])
 
     play_time = queue_time - float(item["start"])
     time_difference = play_time - time.time()
@@ -54,35 +81,28 @@ async def play_item(queue_time, item_id, item):
         previous_keyframe = (time.time(), 0)
 
     mp.play()
+    started = time.time()
 
     # Don't await because we don't care about the response.
     loop.create_task(update_item_status(item_id, "playing"))
 
-    logged = False
-
-    for next_keyframe in keyframes:
-        if item["type"] == "song" and not logged and previous_keyframe[0] == queue_time:
-            executor.submit(log_song, item["song_id"], item["length"])
-            logged = True
-
-        while mp.get_state() != vlc.State.Ended:
-            current_time = time.time()
-            if previous_keyframe[1] == next_keyframe[1] and next_keyframe[0] - current_time > 1:
-                await asyncio.sleep(1)
-                continue
-            if current_time > next_keyframe[0]:
-                print("reached keyframe", next_keyframe)
-                mp.audio_set_volume(next_keyframe[1])
-                break
-            new_volume = previous_keyframe[1] + int(
-                (current_time - previous_keyframe[0])
-                / (next_keyframe[0] - previous_keyframe[0])
-                * (next_keyframe[1] - previous_keyframe[1])
-            )
-            mp.audio_set_volume(new_volume)
-            await asyncio.sleep(0.01)
-
-        previous_keyframe = next_keyframe
+    # Log the song when it reaches its queue time.
+    if item["type"] == "song":
+        log_handle = loop.call_later(
+            max(queue_time - time.time(), 0),
+            play_log.add, item["song_id"], item["length"],
+        )
+
+    envelope = await envelopes.add(mp, [previous_keyframe] + keyframes)
+
+    loop.create_task(timing.record(
+        redis, item_id, item["type"],
+        play_time, started, envelope.audible_at, time.time(), envelope.max_slip,
+    ))
+
+    # Don't log songs which ended before they got there.
+    if item["type"] == "song":
+        log_handle.cancel()
 
     print("ended")
     loop.create_task(update_item_status(item_id, "played"))
@@ -100,33 +120,37 @@ async def stop_item(queue_time, item_id, item):
     if time_difference >= 0:
         await asyncio.sleep(time_difference)
 
+    # There's nothing to fade, so only the lateness counts. Record it before
+    # stopping, because the daemon exits soon after.
+    stopped = time.time()
+    await timing.record(redis, item_id, item["type"], queue_time, stopped, None, stopped, 0)
+
     await redis.hset("item:" + item_id, "status", "played")
-    await redis.publish("update", "update")
+    snapshot.refresh()
     await redis.delete("running")
+    await redis.publish("running", "False")
     await redis.delete("automation_pid")
 
 
 async def update_item_status(item_id, status):
-    await redis.hset("item:" + item_id, "status", "playing")
-    await redis.publish("update", "update")
+    await redis.hset("item:" + item_id, "status", status)
+    snapshot.refresh()
 
 
-def log_song(song_id, length):
-    db = sm()
-    db.add(Play(
-        stream_id=db.query(Stream.id).filter(Stream.url_name == args.stream).as_scalar(),
-        time=datetime.now(),
-        song_id=int(song_id),
-        length=timedelta(0, float(length)),
-    ))
-    db.commit()
+def _timestamp(queue_time):
+    return time.mktime(queue_time.timetuple()) + queue_time.microsecond / 1000000.0
 
 
 async def _queue(queue_time, item_info):
+    global last_queued
     queue_item_id = str(uuid4())
-    await redis.hmset_dict("item:" + queue_item_id, item_info)
-    queue_timestamp = time.mktime(queue_time.timetuple()) + queue_time.microsecond / 1000000.0
-    await redis.zadd("play_queue", queue_timestamp, queue_item_id)
+    number = await redis.incr("queue_number")
+    await redis.hmset_dict("item:" + queue_item_id, item_info, number=number)
+    await redis.zadd("play_queue", _timestamp(queue_time), queue_item_id)
+    # Let the play queue know so it doesn't have to poll.
+    await redis.publish("queue", "%s %s" % (_timestamp(queue_time), queue_item_id))
+    snapshot.refresh()
+    last_queued = (number, queue_item_id, _timestamp(queue_time))
     return queue_item_id
 
 
@@ -141,18 +165,106 @@ async def queue_song(queue_time, song, force_length=None):
         ),
         "song_id": song.id,
         "filename": song.filename,
+        # For the web interface.
+        "name": song.name,
+        "artist": ", ".join(_.name for _ in song.artists),
+        "category": song.category.name,
     }
     queue_item_id = await _queue(queue_time, item_info)
+    queue_timestamp = _timestamp(queue_time)
+    await redis.hset(SONG_LAST_PLAYED, song.id, queue_timestamp)
     if song.artists:
         await redis.sadd("item:" + queue_item_id + ":artists", *(_.id for _ in song.artists))
+        await redis.hmset_dict(ARTIST_LAST_PLAYED, {_.id: queue_timestamp for _ in song.artists})
+    clear_exclusions()
     return queue_item_id
 
 
+async def prune_last_played(key, min_timestamp=float("-inf"), max_timestamp=float("inf")):
+    # Remove last played times outside the given range, either because
+    # they're too old to matter or because the item was removed from the
+    # queue.
+    expired = [
+        item_id for item_id, last_played in (await redis.hgetall(key)).items()
+        if not min_timestamp <= float(last_played) <= max_timestamp
+    ]
+    if expired:
+        await redis.hdel(key, *expired)
+
+
+# Removes everything in the play queue from a timestamp onwards which was
+# queued after a given item number, and points the last played times for
+# their songs and artists back at the latest items which are left, in one
+# step. Items without a number are from before numbering and always go.
+CUT_SCRIPT = """
+local removed = {}
+for _, item_id in ipairs(redis.call("ZRANGEBYSCORE", KEYS[1], ARGV[1], "+inf")) do
+    local number = tonumber(redis.call("HGET", "item:" .. item_id, "number")) or math.huge
+    if number > tonumber(ARGV[3]) then
+        table.insert(removed, item_id)
+    end
+end
+local songs = {}
+local artists = {}
+for _, item_id in ipairs(removed) do
+    local song_id = redis.call("HGET", "item:" .. item_id, "song_id")
+    if song_id then
+        songs[song_id] = true
+    end
+    for _, artist_id in ipairs(redis.call("SMEMBERS", "item:" .. item_id .. ":artists")) do
+        artists[artist_id] = true
+    end
+    redis.call("ZREM", KEYS[1], item_id)
+    redis.call("DEL", "item:" .. item_id, "item:" .. item_id .. ":artists")
+end
+for song_id in pairs(songs) do
+    redis.call("HDEL", KEYS[2], song_id)
+end
+for artist_id in pairs(artists) do
+    redis.call("HDEL", KEYS[3], artist_id)
+end
+-- Oldest first, so later items overwrite earlier ones.
+local remaining = redis.call("ZRANGEBYSCORE", KEYS[1], ARGV[2], "+inf", "WITHSCORES")
+for i = 1, #remaining, 2 do
+    local item_id = remaining[i]
+    local song_id = redis.call("HGET", "item:" .. item_id, "song_id")
+    if song_id and songs[song_id] then
+        redis.call("HSET", KEYS[2], song_id, remaining[i + 1])
+    end
+    for _, artist_id in ipairs(redis.call("SMEMBERS", "item:" .. item_id .. ":artists")) do
+        if artists[artist_id] then
+            redis.call("HSET", KEYS[3], artist_id, remaining[i + 1])
+        end
+    end
+end
+return removed
+"""
+
+
+async def cut_queue(cut_time, lookback, after=0):
+    """
+    Remove every item queued at or after cut_time, apart from the ones
+    numbered `after` or lower, and returns their IDs. Last played times are
+    rebuilt from the items up to `lookback` seconds before the cut.
+    """
+    cut_timestamp = _timestamp(cut_time)
+    removed = await redis.eval(
+        CUT_SCRIPT,
+        keys=["play_queue", SONG_LAST_PLAYED, ARTIST_LAST_PLAYED],
+        args=[repr(cut_timestamp), repr(cut_timestamp - lookback), after],
+    )
+    clear_exclusions()
+    snapshot.refresh()
+    return removed
+
+
 async def queue_stop(queue_time, event):
     return await _queue(queue_time, {
         "status": "queued",
         "type": "stop",
         "event_id": event.id,
+        "name": event.name,
+        "artist": "Stop event",
     })
 
 
@@ -161,6 +273,8 @@ async def queue_event_start(queue_time, event):
         "status": "queued",
         "type": "event_start",
         "event_id": event.id,
+        "name": event.name,
+        "artist": "Start of event",
     })
 
 
@@ -174,6 +288,8 @@ async def queue_event_item(queue_time, event_item):
         "length": event_item.length.total_seconds(),
         "event_item_id": event_item.id,
         "filename": str(event_item.id),
+        "name": event_item.name,
+        "artist": "Audio event",
     })
 
 
@@ -182,5 +298,7 @@ async def queue_event_end(queue_time, event):
         "status": "queued",
         "type": "event_end",
         "event_id": event.id,
+        "name": event.name,
+        "artist": "End of event",
     })
 
@@ -0,0 +1,70 @@
+import asyncio, itertools, time, vlc
+
+
+# States where the player is still opening the file.
+OPENING_STATES = (vlc.State.NothingSpecial, vlc.State.Opening, vlc.State.Buffering)
+
+
+class PlayerPool(object):
+    """
+    Opens media players ahead of time, so starting an item is just a call
+    to play(). Players are created from a few shared vlc.Instances rather
+    than a new instance each time.
+    """
+
+    def __init__(self, size=4, instances=2, timeout=5):
+        self.size = size
+        self.timeout = timeout
+        self.instances = itertools.cycle([vlc.Instance() for n in range(instances)])
+        # Item ID to (expiry time, future of a paused media player).
+        self.prepared = {}
+
+    async def open(self, path):
+        """Open a file and leave it paused and muted at the beginning."""
+        instance = next(self.instances)
+        mp = instance.media_player_new()
+        mp.set_media(instance.media_new(path))
+        mp.audio_set_volume(0)
+        mp.play()
+        started = time.time()
+        while mp.get_state() in OPENING_STATES:
+            if time.time() - started > self.timeout:
+                print("TIMED OUT OPENING", path)
+                break
+            await asyncio.sleep(0.01)
+        mp.pause()
+        mp.set_time(0)
+        return mp
+
+    def prepare(self, item_id, path, expires):
+        """
+        Start opening a file for an item. Returns False if the pool is full.
+        """
+        if item_id in self.prepared:
+            return True
+        if len(self.prepared) >= self.size:
+            return False
+        self.prepared[item_id] = (expires, asyncio.ensure_future(self.open(path)))
+        return True
+
+    async def take(self, item_id):
+        """Returns the prepared player for an item, or None if there isn't one."""
+        if item_id not in self.prepared:
+            return None
+        expires, mp = self.prepared.pop(item_id)
+        return await mp
+
+    def cleanup(self):
+        # Release players for items which were never played, for example
+        # because they were removed from the queue.
+        for item_id, (expires, mp) in list(self.prepared.items()):
+            if expires < time.time():
+                del self.prepared[item_id]
+                mp.add_done_callback(_release)
+
+
+def _release(future):
+    if future.exception() is None:
+        mp = future.result()
+        mp.stop()
+        mp.release()
@@ -0,0 +1,195 @@
+import asyncio, json, os
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy.exc import DBAPIError, OperationalError, SQLAlchemyError
+
+from automated import metrics, rollups
+from automated.db import sm, Play, Stream
+
+
+# How times are written in the spool file.
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+play_log_writes = metrics.Counter("automated_play_log_writes_total", "Plays written to the database, the spool file or the reject file.")
+
+
+class PlayLog(object):
+    """
+    Buffers plays in memory and writes them to the database in batches from
+    one background thread, so playout never waits for Postgres. If the
+    database can't be reached the plays are appended to a spool file, which
+    is written to the database before anything else once it's back. Plays
+    the database won't accept go to a reject file next to the spool.
+    """
+
+    def __init__(self, stream, spool_path, batch_size=50, interval=5):
+        self.stream = stream
+        self.spool_path = spool_path
+        self.reject_path = spool_path + ".rejected"
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stream_id = None
+        # (time, song ID, length) for plays which haven't been written yet.
+        self.buffer = []
+        # One thread, so batches are written in order.
+        self.executor = ThreadPoolExecutor(1)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def add(self, song_id, length, time=None):
+        self.buffer.append((time or datetime.now(), int(song_id), timedelta(0, float(length))))
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+        self.start()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        # Keep going while there's anything left, including plays in the
+        # spool file waiting for the database to come back.
+        while self.buffer or os.path.exists(self.spool_path):
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        plays, self.buffer = self.buffer, []
+        await asyncio.get_event_loop().run_in_executor(self.executor, self.write, plays)
+
+    def write(self, plays):
+        if self.replay():
+            # The database is still unavailable, so keep these behind the
+            # ones already waiting.
+            self.spool(plays)
+            return
+        unwritten = self.save(plays)
+        if unwritten:
+            self.spool(unwritten)
+
+    def save(self, plays):
+        """
+        Write plays to the database. Plays which fail for any reason other
+        than the database being unavailable are put aside in the reject
+        file, so one bad row can't hold up the rest. Returns the plays which
+        couldn't be written because the database was unavailable.
+        """
+        try:
+            self.insert(plays)
+            return []
+        except SQLAlchemyError as e:
+            if unavailable(e):
+                print("COULDN'T WRITE %s PLAYS, SPOOLING:" % len(plays), e)
+                return plays
+            print("COULDN'T WRITE %s PLAYS, TRYING ONE AT A TIME:" % len(plays), e)
+        for n, play in enumerate(plays):
+            try:
+                self.insert([play])
+            except SQLAlchemyError as e:
+                if unavailable(e):
+                    print("COULDN'T WRITE %s PLAYS, SPOOLING:" % len(plays[n:]), e)
+                    return plays[n:]
+                print("REJECTING PLAY:", play, e)
+                self.reject(play, e)
+        return []
+
+    def insert(self, plays):
+        if not plays:
+            return
+        db = sm()
+        try:
+            if self.stream_id is None:
+                self.stream_id = db.query(Stream.id).filter(Stream.url_name == self.stream).scalar()
+            db.execute(Play.__table__.insert(), [
+                {
+                    "stream_id": self.stream_id,
+                    "time": time,
+                    "length": length,
+                    "type": "song",
+                    "song_id": song_id,
+                }
+                for time, song_id, length in plays
+            ])
+            rollups.record_plays(db, [
+                (self.stream_id, time, song_id, length) for time, song_id, length in plays
+            ])
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        play_log_writes.inc(len(plays), to="database")
+
+    def spool(self, plays, replace=False):
+        # Replacing the spool writes a new file and moves it over the old
+        # one, so a crash can't leave half of it.
+        path = self.spool_path + ".tmp" if replace else self.spool_path
+        with open(path, "w" if replace else "a") as f:
+            for play in plays:
+                f.write(json.dumps(_play_to_json(play)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if replace:
+            os.replace(path, self.spool_path)
+        else:
+            play_log_writes.inc(len(plays), to="spool")
+
+    def reject(self, play, error):
+        with open(self.reject_path, "a") as f:
+            line = _play_to_json(play)
+            line["error"] = str(error).splitlines()[0] if str(error) else repr(error)
+            f.write(json.dumps(line) + "\n")
+        play_log_writes.inc(to="rejected")
+
+    def replay(self):
+        """
+        Write the plays in the spool file to the database. Returns True if
+        some of them are still waiting because the database is unavailable.
+        """
+        if not os.path.exists(self.spool_path):
+            return False
+        plays = []
+        with open(self.spool_path) as f:
+            for line in f:
+                try:
+                    play = json.loads(line)
+                    plays.append((
+                        datetime.strptime(play["time"], TIME_FORMAT),
+                        play["song_id"],
+                        timedelta(0, play["length"]),
+                    ))
+                except (ValueError, KeyError):
+                    # Probably cut off by a crash while it was being written.
+                    print("SKIPPING BAD LINE IN SPOOL:", line)
+        unwritten = self.save(plays)
+        if unwritten:
+            # Leave the rest to try again later.
+            if len(unwritten) < len(plays):
+                self.spool(unwritten, replace=True)
+            return True
+        os.remove(self.spool_path)
+        print("REPLAYED %s PLAYS FROM SPOOL" % len(plays))
+        return False
+
+
+def unavailable(error):
+    # Only errors from the connection mean the plays should be kept for
+    # later. Anything else is a problem with the plays themselves.
+    return isinstance(error, OperationalError) or (
+        isinstance(error, DBAPIError) and error.connection_invalidated
+    )
+
+
+def _play_to_json(play):
+    time, song_id, length = play
+    return {
+        "time": time.strftime(TIME_FORMAT),
+        "song_id": song_id,
+        "length": length.total_seconds(),
+    }
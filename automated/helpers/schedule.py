@@ -1,26 +1,88 @@
-import time
+import threading, time
 
 from datetime import datetime, timedelta
 from redis import StrictRedis
-from sqlalchemy import and_, func, or_
-from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 
 from automated.db import (
     session_scope,
-    Artist,
     Category,
     Event,
     Sequence,
     SequenceItem,
-    Song,
     Stream,
 )
 from automated.helpers.args import args
+from automated.helpers.calendar import EventCalendar, event_query, event_signature
+from automated.helpers.catalog import Catalog
+from automated.metrics import Histogram
 
 
 redis = StrictRedis(decode_responses=True)
 
+catalog = Catalog()
+
+calendar = EventCalendar(args.stream, args.calendar_hours)
+
+pick_song_seconds = Histogram("automated_pick_song_seconds", "Time taken to pick a song.")
+
+# Hashes of song and artist IDs to the timestamp they were last queued.
+SONG_LAST_PLAYED = "song_last_played:" + args.stream
+ARTIST_LAST_PLAYED = "artist_last_played:" + args.stream
+
+# Returns the song IDs and artist IDs which were played too recently to be
+# picked at the given timestamp, in one round trip.
+exclusions_script = redis.register_script("""
+local queue_timestamp = tonumber(ARGV[1])
+local result = {}
+for n = 1, 2 do
+    local threshold = queue_timestamp - tonumber(redis.call("GET", KEYS[n]) or 0)
+    local last_played = redis.call("HGETALL", KEYS[n + 2])
+    local ids = {}
+    for i = 1, #last_played, 2 do
+        if tonumber(last_played[i + 1]) > threshold then
+            table.insert(ids, last_played[i])
+        end
+    end
+    result[n] = ids
+end
+return result
+""")
+
+# Returns which of the given songs were played too recently to be picked at
+# the given timestamp, looking up only those songs and their artists. ARGV
+# is the timestamp, then each song ID followed by its number of artists and
+# their IDs.
+recent_script = redis.register_script("""
+local queue_timestamp = tonumber(ARGV[1])
+local song_threshold = queue_timestamp - tonumber(redis.call("GET", KEYS[1]) or 0)
+local artist_threshold = queue_timestamp - tonumber(redis.call("GET", KEYS[2]) or 0)
+local result = {}
+local n = 2
+while n <= #ARGV do
+    local song_id = ARGV[n]
+    local artist_count = tonumber(ARGV[n + 1])
+    local last_played = redis.call("HGET", KEYS[3], song_id)
+    local recent = last_played and tonumber(last_played) > song_threshold
+    for i = 1, artist_count do
+        if not recent then
+            last_played = redis.call("HGET", KEYS[4], ARGV[n + 1 + i])
+            recent = last_played and tonumber(last_played) > artist_threshold
+        end
+    end
+    if recent then
+        table.insert(result, song_id)
+    end
+    n = n + 2 + artist_count
+end
+return result
+""")
+
+# Exclusions are cached by queue timestamp, because parallel plan attempts
+# all ask at the same time. This needs clearing whenever something is queued.
+exclusions_cache = {}
+exclusions_lock = threading.Lock()
+
 
 def get_stream():
     with session_scope() as db:
@@ -32,34 +94,30 @@ def get_default_sequence():
         return db.query(Sequence).join(Stream).filter(Stream.url_name == args.stream).first()
 
 
-def find_event(last_event, range_start):
+def find_event(last_event, range_start, range_seconds=3600):
+    after = last_event.start_time if last_event else range_start
+    return calendar.next_event(after, range_start + timedelta(0, range_seconds))
+
+
+def get_event(event_id):
+    with session_scope() as db:
+        return event_query(db).filter(Event.id == event_id).one()
+
+
+def find_events(range_start, range_end):
+    """
+    Returns a dict of ID to start time and signature for the events in a
+    time range.
+    """
+    return {
+        event.id: (event.start_time, event_signature(event))
+        for event in calendar.between(range_start, range_end)
+    }
+
+
+def get_sequence(sequence_id):
     with session_scope() as db:
-        event_query = db.query(Event).filter(Event.stream_id == (
-            db.query(Stream.id).filter(Stream.url_name == args.stream)
-        ))
-        if last_event:
-            event_query = event_query.filter(Event.start_time > last_event.start_time)
-        else:
-            event_query = event_query.filter(Event.start_time > range_start)
-        range_end = range_start + timedelta(0, 3600)
-        event_query = event_query.filter(Event.start_time <= range_end)
-        event_query = event_query.order_by(Event.start_time)
-
-        event = event_query.first()
-
-        # Force SQLAlchemy to fetch associated items before we destroy the session.
-        # doing this because i have no idea how to get joinedload() to fetch them
-        # TODO figure that out
-        if event:
-            event.sequence
-            for item in event.items:
-                item.start_time
-                if hasattr(item, "song"):
-                    item.song.artists
-                if hasattr(item, "start"):
-                    item.start
-
-        return event
+        return db.query(Sequence).filter(Sequence.id == sequence_id).one()
 
 
 def populate_sequence_items(sequence):
@@ -70,46 +128,63 @@ def populate_sequence_items(sequence):
 
 
 def pick_song(queue_time, category_id=None, songs=None, artists=None, length=None):
-    with session_scope() as db:
-
-        song_query = db.query(Song).order_by(func.random())
-
-        if category_id is not None:
-            song_query = song_query.filter(Song.category_id == category_id)
-
-        queue_timestamp = time.mktime(queue_time.timetuple())
-
-        # Song limit
-        song_timestamp = queue_timestamp - float(redis.get("song_limit"))
-        if songs is None:
-            songs = set()
-        for item_id in redis.zrangebyscore("play_queue", song_timestamp, queue_timestamp):
-            song_id = redis.hget("item:" + item_id, "song_id")
-            if song_id is not None:
-                songs.add(song_id)
-        if len(songs) != 0:
-            song_query = song_query.filter(~Song.id.in_(songs))
-
-        # Artist limit
-        artist_timestamp = queue_timestamp - float(redis.get("artist_limit"))
-        if artists is None:
-            artists = set()
-        for item_id in redis.zrangebyscore("play_queue", artist_timestamp, queue_timestamp):
-            artists = artists | redis.smembers("item:" + item_id + ":artists")
-        if len(artists) != 0:
-            song_query = song_query.filter(~Song.artists.any(Artist.id.in_(artists)))
-
-        song_query = song_query.options(joinedload(Song.artists))
-
-        if length is not None:
-            length_song = song_query.filter(and_(
-                Song.min_end-Song.start <= length,
-                Song.max_end-Song.start >= length,
-            )).first()
-            if length_song is not None:
-                return length_song
-
-        return song_query.first()
+    with pick_song_seconds.time():
+        return _pick_song(queue_time, category_id, songs, artists, length)
+
+
+def _pick_song(queue_time, category_id, songs, artists, length):
+
+    catalog.refresh()
+
+    queue_timestamp = time.mktime(queue_time.timetuple())
+
+    return catalog.pick(
+        category_id,
+        set(int(_) for _ in songs) if songs else None,
+        set(int(_) for _ in artists) if artists else None,
+        length,
+        lambda candidates: recently_played(queue_timestamp, candidates),
+    )
+
+
+def recently_played(queue_timestamp, songs):
+    """
+    Returns the IDs of the songs which can't be picked at a timestamp
+    because they or their artists were played within the repetition limits.
+    """
+    script_args = [queue_timestamp]
+    for song in songs:
+        artist_ids = catalog.song_artists.get(song.id, ())
+        script_args += [song.id, len(artist_ids)] + list(artist_ids)
+    return set(int(_) for _ in recent_script(
+        keys=["song_limit", "artist_limit", SONG_LAST_PLAYED, ARTIST_LAST_PLAYED],
+        args=script_args,
+    ))
+
+
+def get_exclusions(queue_timestamp):
+    with exclusions_lock:
+        if queue_timestamp in exclusions_cache:
+            return exclusions_cache[queue_timestamp]
+    songs, artists = exclusions_script(
+        keys=["song_limit", "artist_limit", SONG_LAST_PLAYED, ARTIST_LAST_PLAYED],
+        args=[queue_timestamp],
+    )
+    exclusions = (
+        frozenset(int(_) for _ in songs),
+        frozenset(int(_) for _ in artists),
+    )
+    with exclusions_lock:
+        # Don't let the cache grow forever if nothing gets queued.
+        if len(exclusions_cache) >= 100:
+            exclusions_cache.clear()
+        exclusions_cache[queue_timestamp] = exclusions
+    return exclusions
+
+
+def clear_exclusions():
+    with exclusions_lock:
+        exclusions_cache.clear()
 
 
 def start_event(event_id):
@@ -0,0 +1,107 @@
+import asyncio, aioredis, json, time
+
+from automated.helpers.args import args
+
+
+loop = asyncio.get_event_loop()
+redis = loop.run_until_complete(aioredis.create_redis(("127.0.0.1", 6379), encoding="utf-8"))
+
+# Fields from the item hashes which are shown in the web interface.
+VIEW_FIELDS = ("status", "type", "length", "name", "artist", "category")
+
+# How many deltas to keep for clients catching up. Clients further behind
+# than this get the whole snapshot again.
+MAX_DELTAS = 100
+
+refresh_task = None
+
+# The items in the last snapshot, by ID, to work out what changed.
+previous_items = None
+
+
+def refresh():
+    """
+    Rebuild the queue snapshot shortly. Changes which happen close together,
+    such as queueing a whole plan, only cause one rebuild.
+    """
+    global refresh_task
+    if refresh_task is None:
+        refresh_task = loop.create_task(_refresh())
+
+
+async def _refresh():
+    global refresh_task
+    await asyncio.sleep(0.1)
+    # Anything which changes from here on needs another rebuild.
+    refresh_task = None
+    await rebuild()
+
+
+async def rebuild():
+    """
+    Store the part of the play queue shown in the web interface as one JSON
+    key, so the web app doesn't need to look up every item itself.
+
+    Every time the snapshot changes its version goes up, and the items which
+    were inserted, removed or changed status are stored as a delta so
+    clients can update their copy without fetching all of it.
+    """
+    global previous_items
+    now = time.time()
+    queue = await redis.zrangebyscore(
+        "play_queue", now - args.snapshot_past, now + args.snapshot_future, withscores=True,
+    )
+
+    pipeline = redis.pipeline()
+    for item_id, queue_time in queue:
+        pipeline.hgetall("item:" + item_id)
+    item_hashes = await pipeline.execute()
+
+    items = []
+    for (item_id, queue_time), item in zip(queue, item_hashes):
+        if not item:
+            continue
+        view = {field: item[field] for field in VIEW_FIELDS if field in item}
+        view["id"] = item_id
+        view["time"] = queue_time
+        if "length" in view:
+            view["length"] = float(view["length"])
+        items.append(view)
+
+    current_items = {item["id"]: item for item in items}
+    if previous_items is None:
+        # We don't know what clients have, so don't keep any deltas. They'll
+        # all see they're behind and load the whole snapshot.
+        delta = None
+    else:
+        delta = {
+            "inserted": [],
+            "removed": [item_id for item_id in previous_items if item_id not in current_items],
+            "changed": [],
+        }
+        for item in items:
+            previous = previous_items.get(item["id"])
+            if previous is None:
+                delta["inserted"].append(item)
+            elif previous != item:
+                if dict(previous, status=item["status"]) == item:
+                    delta["changed"].append({"id": item["id"], "status": item["status"]})
+                else:
+                    # Anything else changing is sent as a new item in its place.
+                    delta["removed"].append(item["id"])
+                    delta["inserted"].append(item)
+        if not any(delta.values()):
+            return
+    previous_items = current_items
+
+    version = await redis.incr("queue_version")
+    transaction = redis.multi_exec()
+    transaction.set("queue_snapshot", json.dumps({"time": now, "version": version, "items": items}))
+    if delta is None:
+        transaction.delete("queue_deltas")
+    else:
+        delta["version"] = version
+        transaction.rpush("queue_deltas", json.dumps(delta))
+        transaction.ltrim("queue_deltas", -MAX_DELTAS, -1)
+    await transaction.execute()
+    await redis.publish("update", version)
@@ -0,0 +1,149 @@
+import copy, json
+
+from datetime import datetime
+
+
+class SchedulerState(object):
+    """
+    Everything the scheduler needs to carry on planning from next_time. A
+    copy is kept after each step, so planning can go back to an earlier
+    point without starting again from now.
+    """
+
+    def __init__(self, next_time, sequence, sequence_items):
+        self.next_time = next_time
+        self.current_event = None
+        self.current_event_items = []
+        self.next_event = None
+        self.sequence = sequence
+        self.sequence_items = sequence_items
+        # Event ID to the start time and signature it was planned with, so we
+        # can tell if events change after they've been planned.
+        self.planned_events = {}
+        # Number of the last item queued before this point. Anything queued
+        # after it is cut when planning goes back here, even items at
+        # exactly next_time.
+        self.last_queued = 0
+
+    def copy(self):
+        # The ORM objects are never changed, so they can be shared, but the
+        # lists get popped while planning.
+        state = copy.copy(self)
+        state.current_event_items = list(self.current_event_items)
+        state.sequence_items = list(self.sequence_items)
+        state.planned_events = dict(self.planned_events)
+        return state
+
+    def forget_events(self, before):
+        # Events before this can't be re-planned any more.
+        self.planned_events = {
+            event_id: planned for event_id, planned in self.planned_events.items()
+            if planned[0] >= before
+        }
+
+    def update_sequence(self, sequence, sequence_items):
+        """
+        Switch to `sequence`, whose items are `sequence_items`. If it's the
+        sequence we're already on, carry on from the same position in it, so
+        edits to it don't start the rotation again.
+        """
+        same = (sequence.id if sequence else None) == (self.sequence.id if self.sequence else None)
+        if same and self.sequence_items:
+            position = self.sequence_items[0][0].number
+            self.sequence_items = [_ for _ in sequence_items if _[0].number >= position] or list(sequence_items)
+        else:
+            self.sequence_items = list(sequence_items)
+        self.sequence = sequence
+
+    def to_json(self):
+        # Only IDs are kept, so this stays small enough to write after every
+        # step. The rows are fetched again when it's loaded.
+        return json.dumps({
+            "next_time": self.next_time.timestamp(),
+            "current_event": self.current_event.id if self.current_event else None,
+            "current_event_items": [item.id for item in self.current_event_items],
+            "next_event": self.next_event.id if self.next_event else None,
+            "sequence": self.sequence.id if self.sequence else None,
+            "sequence_items": [item.number for item, category in self.sequence_items],
+            "planned_events": {
+                event_id: [start_time.timestamp(), signature]
+                for event_id, (start_time, signature) in self.planned_events.items()
+            },
+            "last_queued": self.last_queued,
+        })
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Load a state saved with to_json. Raises ValueError if its events or
+        sequence have been deleted since. Event items which have been
+        deleted are left out.
+        """
+        # Imported here so the checkpoints can be used without the
+        # database or Redis.
+        from sqlalchemy.orm.exc import NoResultFound
+        from automated.helpers.schedule import get_event, get_sequence, populate_sequence_items
+
+        data = json.loads(data)
+        try:
+            sequence = get_sequence(data["sequence"]) if data["sequence"] else None
+            current_event = get_event(data["current_event"]) if data["current_event"] else None
+            next_event = get_event(data["next_event"]) if data["next_event"] else None
+        except NoResultFound:
+            raise ValueError("saved state refers to something which has been deleted")
+
+        # Carry on from the same place in the sequence, even if it's been
+        # edited since.
+        sequence_items = populate_sequence_items(sequence)
+        if data["sequence_items"]:
+            position = data["sequence_items"][0]
+            sequence_items = [_ for _ in sequence_items if _[0].number >= position] or sequence_items
+        else:
+            sequence_items = []
+        state = cls(datetime.fromtimestamp(data["next_time"]), sequence, sequence_items)
+        state.current_event = current_event
+        if current_event:
+            event_items = {item.id: item for item in current_event.items}
+            state.current_event_items = [
+                event_items[item_id] for item_id in data["current_event_items"] if item_id in event_items
+            ]
+        state.next_event = next_event
+        state.planned_events = {
+            int(event_id): (datetime.fromtimestamp(start_time), signature)
+            for event_id, (start_time, signature) in data["planned_events"].items()
+        }
+        state.last_queued = data.get("last_queued", 0)
+        return state
+
+
+class Checkpoints(object):
+    """Copies of the scheduler state, in order of next_time."""
+
+    def __init__(self):
+        self.states = []
+
+    def add(self, state):
+        self.states.append(state.copy())
+
+    def trim(self, before):
+        # Keep the last one before the cutoff, because that's where planning
+        # would have to go back to for anything after it.
+        while len(self.states) > 1 and self.states[1].next_time <= before:
+            self.states.pop(0)
+        for state in self.states:
+            state.forget_events(self.states[0].next_time)
+
+    def restore(self, cut_time, earliest):
+        """
+        Returns a copy of the latest state at or before cut_time which is no
+        earlier than `earliest`, and forgets the ones after it. If there
+        isn't one, the first one after `earliest` is used instead. Returns
+        None if there are no states after `earliest` at all.
+        """
+        candidates = [n for n, state in enumerate(self.states) if state.next_time >= earliest]
+        if not candidates:
+            return None
+        before_cut = [n for n in candidates if self.states[n].next_time <= cut_time]
+        n = before_cut[-1] if before_cut else candidates[0]
+        del self.states[n + 1:]
+        return self.states[n].copy()
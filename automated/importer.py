@@ -0,0 +1,253 @@
+import csv, json, os, shutil, time
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from sqlalchemy import text
+from werkzeug import secure_filename
+
+from automated import probe
+from automated.db import sm, Artist, Category, Song, song_artists, string_to_timedelta
+
+
+AUDIO_EXTENSIONS = (".flac", ".m4a", ".mp3", ".ogg", ".wav")
+
+parser = ArgumentParser(prog="automated import", description="Import songs in bulk.")
+parser.add_argument(
+    "source",
+    help="Directory to import audio files from, or a CSV or JSON manifest",
+)
+parser.add_argument(
+    "--category",
+    help="Category for songs which don't have one. Defaults to the name of the directory each file is in",
+)
+parser.add_argument("--song-path", default="songs", help="Song path")
+parser.add_argument(
+    "--link", action="store_true",
+    help="Hard link files into the song path instead of copying them",
+)
+parser.add_argument(
+    "--workers", type=int, default=None,
+    help="Number of processes to probe files with",
+)
+parser.add_argument(
+    "--batch-size", type=int, default=500,
+    help="How many songs to insert in each transaction",
+)
+parser.add_argument(
+    "--dry-run", action="store_true",
+    help="Check the files without importing anything",
+)
+
+
+def main(argv):
+    args = parser.parse_args(argv)
+    started = time.time()
+
+    if os.path.isdir(args.source):
+        entries = list(walk(args.source, args.category))
+    else:
+        entries = list(read_manifest(args.source, args.category))
+    print("FOUND %s FILES" % len(entries))
+
+    # Probing is mostly waiting for ffprobe or parsing headers, so spread it
+    # over a few processes.
+    with ProcessPoolExecutor(args.workers) as pool:
+        infos = list(pool.map(_probe, [entry["path"] for entry in entries], chunksize=16))
+    probed = time.time()
+    print("PROBED %s FILES IN %.1f SECONDS (%.1f FILES/S)" % (
+        len(entries), probed - started, len(entries) / max(probed - started, 0.001),
+    ))
+
+    songs = []
+    for entry, info in zip(entries, infos):
+        try:
+            songs.append(validate(entry, info))
+        except ValueError as e:
+            print("SKIPPING %s: %s" % (entry["path"], e))
+
+    if args.dry_run:
+        print("%s OF %s FILES WOULD BE IMPORTED" % (len(songs), len(entries)))
+        return
+
+    imported = insert(songs, args.song_path, args.link, args.batch_size)
+    finished = time.time()
+    print("IMPORTED %s OF %s FILES IN %.1f SECONDS (%.1f SONGS/S)" % (
+        imported, len(entries), finished - started, imported / max(finished - started, 0.001),
+    ))
+
+
+def walk(directory, category=None):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1].lower() not in AUDIO_EXTENSIONS:
+                continue
+            title = os.path.splitext(filename)[0]
+            artists = []
+            # Files are often named "Artist - Title".
+            if " - " in title:
+                artist, title = title.split(" - ", 1)
+                artists = [artist]
+            yield {
+                "path": os.path.join(root, filename),
+                "title": title,
+                "artists": artists,
+                "category": category or os.path.basename(os.path.abspath(root)),
+            }
+
+
+def read_manifest(path, category=None):
+    """
+    Reads a CSV or JSON manifest of songs. Each one has a path, relative to
+    the manifest, and can have a title, artists, category and start, end,
+    min_end and max_end cue points.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        if path.lower().endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    for row in rows:
+        artists = row.get("artists") or row.get("artist") or []
+        if not isinstance(artists, list):
+            artists = artists.split(",")
+        entry = {
+            "path": os.path.join(base, row["path"]),
+            "title": row.get("title") or os.path.splitext(os.path.basename(row["path"]))[0],
+            "artists": artists,
+            "category": row.get("category") or category,
+        }
+        for cue in ("start", "end", "min_end", "max_end"):
+            if row.get(cue) not in (None, ""):
+                entry[cue] = str(row[cue])
+        yield entry
+
+
+def _probe(path):
+    try:
+        return probe.probe(path)
+    except (probe.ProbeError, OSError):
+        return None
+
+
+def validate(entry, info):
+    """Returns the values for a new song, or raises ValueError."""
+    if info is None:
+        raise ValueError("not a valid audio file")
+    title = entry["title"].strip()[:50]
+    if not title:
+        raise ValueError("no title")
+    if not entry["category"]:
+        raise ValueError("no category")
+
+    cues = {}
+    for cue in ("start", "end", "min_end", "max_end"):
+        if cue in entry:
+            cues[cue] = string_to_timedelta(entry[cue])
+    start = cues.get("start", timedelta(0))
+    end = cues.get("end", timedelta(0, info.duration))
+    min_end = cues.get("min_end", end)
+    max_end = cues.get("max_end", end)
+    if not start < min_end <= end <= max_end:
+        raise ValueError("cue points are out of order")
+
+    return {
+        "path": entry["path"],
+        "name": title,
+        "artists": [_.strip()[:50] for _ in entry["artists"] if _.strip()],
+        "category": entry["category"].strip()[:50],
+        "start": start,
+        "end": end,
+        "min_end": min_end,
+        "max_end": max_end,
+    }
+
+
+def insert(songs, song_path, link=False, batch_size=500):
+    db = sm()
+    try:
+        # Everything is looked up once and kept in memory, by lowercase name
+        # for artists so they're matched the same way as in the web app.
+        categories = {name: category_id for category_id, name in db.query(Category.id, Category.name)}
+        artists = {name.lower(): artist_id for artist_id, name in db.query(Artist.id, Artist.name)}
+
+        new_categories = sorted(set(song["category"] for song in songs) - set(categories))
+        if new_categories:
+            for category_id, name in zip(_reserve_ids(db, Category, len(new_categories)), new_categories):
+                categories[name] = category_id
+            db.execute(Category.__table__.insert(), [
+                {"id": categories[name], "name": name} for name in new_categories
+            ])
+            db.commit()
+
+        imported = 0
+        for n in range(0, len(songs), batch_size):
+            batch_started = time.time()
+            batch = songs[n:n + batch_size]
+
+            new_artists = {}
+            for song in batch:
+                for name in song["artists"]:
+                    if name.lower() not in artists and name.lower() not in new_artists:
+                        new_artists[name.lower()] = name
+            if new_artists:
+                for artist_id, key in zip(_reserve_ids(db, Artist, len(new_artists)), new_artists):
+                    artists[key] = artist_id
+                db.execute(Artist.__table__.insert(), [
+                    {"id": artists[key], "name": name} for key, name in new_artists.items()
+                ])
+
+            song_rows = []
+            artist_rows = []
+            for song_id, song in zip(_reserve_ids(db, Song, len(batch)), batch):
+                filename = ("%s_%s" % (song_id, secure_filename(os.path.basename(song["path"]))))[:100]
+                song_rows.append({
+                    "id": song_id,
+                    "category_id": categories[song["category"]],
+                    "name": song["name"],
+                    "start": song["start"],
+                    "end": song["end"],
+                    "min_end": song["min_end"],
+                    "max_end": song["max_end"],
+                    "filename": filename,
+                })
+                for artist_id in set(artists[name.lower()] for name in song["artists"]):
+                    artist_rows.append({"song_id": song_id, "artist_id": artist_id})
+                _place(song["path"], os.path.join(song_path, filename), link)
+            db.execute(Song.__table__.insert(), song_rows)
+            if artist_rows:
+                db.execute(song_artists.insert(), artist_rows)
+            db.commit()
+
+            imported += len(batch)
+            print("IMPORTED %s/%s (%.1f SONGS/S)" % (
+                imported, len(songs), len(batch) / max(time.time() - batch_started, 0.001),
+            ))
+        return imported
+    except:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _reserve_ids(db, model, count):
+    # Take IDs from the table's sequence up front so rows can be inserted
+    # with executemany and still be referred to by other rows.
+    sequence = "%s_id_seq" % model.__tablename__
+    return [row[0] for row in db.execute(
+        text("SELECT nextval(:sequence) FROM generate_series(1, :count)"),
+        {"sequence": sequence, "count": count},
+    )]
+
+
+def _place(source, destination, link):
+    if link:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
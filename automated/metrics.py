@@ -0,0 +1,127 @@
+import threading, time
+
+from contextlib import contextmanager
+
+
+# Default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, float("inf"))
+
+
+class Registry(object):
+    """A set of metrics which can be rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        return "".join(_.render() for _ in self.metrics)
+
+
+registry = Registry()
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, registry=registry):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def render(self):
+        lines = [
+            "# HELP %s %s\n" % (self.name, self.help),
+            "# TYPE %s %s\n" % (self.name, self.type),
+        ]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("%s%s %s\n" % (self.name, _labels(labels), _number(value)))
+        return "".join(lines)
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, registry=registry):
+        super(Histogram, self).__init__(name, help, registry)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * len(self.buckets), [0])
+            counts, total = self.values[key]
+            for n, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[n] += 1
+                    break
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def render(self):
+        lines = [
+            "# HELP %s %s\n" % (self.name, self.help),
+            "# TYPE %s %s\n" % (self.name, self.type),
+        ]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append("%s_bucket%s %s\n" % (
+                        self.name,
+                        _labels(labels + (("le", _number(upper_bound)),)),
+                        cumulative,
+                    ))
+                lines.append("%s_sum%s %s\n" % (self.name, _labels(labels), _number(total[0])))
+                lines.append("%s_count%s %s\n" % (self.name, _labels(labels), cumulative))
+        return "".join(lines)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
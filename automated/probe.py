@@ -0,0 +1,108 @@
+import hashlib, json, os, wave
+
+from collections import namedtuple
+from pydub import AudioSegment
+from pydub.utils import mediainfo
+from redis import StrictRedis
+from redis.exceptions import RedisError
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+
+redis = StrictRedis(decode_responses=True)
+
+AudioInfo = namedtuple("AudioInfo", ("duration", "sample_rate", "channels", "method"))
+
+# Redis hash of cache key to probe results.
+CACHE_KEY = "probe_cache"
+
+# How much of each end of a file goes into its cache key.
+HASH_CHUNK = 1024 * 1024
+
+
+class ProbeError(Exception):
+    pass
+
+
+def probe(path):
+    """
+    Returns the duration in seconds, sample rate and channel count of an
+    audio file. These are read from the file's headers where possible, and
+    the file is only decoded if nothing else can read it. Results are
+    cached by the file's contents and modification time.
+    """
+    key = cache_key(path)
+    try:
+        cached = redis.hget(CACHE_KEY, key)
+    except RedisError:
+        # Carry on without the cache.
+        cached = None
+    if cached is not None:
+        return AudioInfo(*json.loads(cached))
+    for method in (_probe_wave, _probe_mutagen, _probe_ffprobe, _probe_decode):
+        try:
+            info = method(path)
+        except Exception:
+            continue
+        if info is not None and info.duration > 0:
+            try:
+                redis.hset(CACHE_KEY, key, json.dumps(info))
+            except RedisError:
+                pass
+            return info
+    raise ProbeError("Couldn't read %s as an audio file." % path)
+
+
+def cache_key(path):
+    # Hashing the start and end of the file along with its size catches any
+    # realistic change without reading all of a long file.
+    stat = os.stat(path)
+    file_hash = hashlib.sha1(str(stat.st_size).encode("utf-8"))
+    with open(path, "rb") as f:
+        file_hash.update(f.read(HASH_CHUNK))
+        if stat.st_size > HASH_CHUNK * 2:
+            f.seek(-HASH_CHUNK, os.SEEK_END)
+        file_hash.update(f.read(HASH_CHUNK))
+    return "%s:%s" % (file_hash.hexdigest(), stat.st_mtime)
+
+
+def _probe_wave(path):
+    with wave.open(path, "rb") as f:
+        return AudioInfo(
+            f.getnframes() / float(f.getframerate()),
+            f.getframerate(),
+            f.getnchannels(),
+            "wave",
+        )
+
+
+def _probe_mutagen(path):
+    if mutagen is None:
+        return None
+    audio = mutagen.File(path)
+    if audio is None:
+        return None
+    return AudioInfo(
+        audio.info.length,
+        getattr(audio.info, "sample_rate", None),
+        getattr(audio.info, "channels", None),
+        "mutagen",
+    )
+
+
+def _probe_ffprobe(path):
+    info = mediainfo(path)
+    return AudioInfo(
+        float(info["duration"]),
+        int(info["sample_rate"]) if "sample_rate" in info else None,
+        int(info["channels"]) if "channels" in info else None,
+        "ffprobe",
+    )
+
+
+def _probe_decode(path):
+    segment = AudioSegment.from_file(path)
+    return AudioInfo(segment.duration_seconds, segment.frame_rate, segment.channels, "decode")
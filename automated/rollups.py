@@ -0,0 +1,195 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import Date, and_, cast, desc, func, literal
+from sqlalchemy.dialects.postgresql import insert
+
+from automated.db import (
+    session_scope,
+    Artist,
+    Category,
+    DailyPlays,
+    HourlyPlays,
+    Play,
+    RollupProgress,
+    Song,
+    song_artists,
+)
+
+
+# How much to rebuild in each transaction when catching up, a day at a time.
+CATCH_UP_CHUNK = timedelta(1)
+
+
+def hour_of(time):
+    return time.replace(minute=0, second=0, microsecond=0)
+
+
+def record_plays(db, plays):
+    """
+    Add plays to the rollups as they're logged. Plays are (stream ID, time,
+    song ID, length) tuples.
+    """
+    if not plays:
+        return
+    song_ids = set(song_id for stream_id, time, song_id, length in plays)
+    categories = dict(db.query(Song.id, Song.category_id).filter(Song.id.in_(song_ids)))
+    artists = defaultdict(list)
+    for song_id, artist_id in db.query(
+        song_artists.c.song_id, song_artists.c.artist_id,
+    ).filter(song_artists.c.song_id.in_(song_ids)):
+        artists[song_id].append(artist_id)
+
+    hourly = defaultdict(lambda: [0, timedelta(0)])
+    for stream_id, time, song_id, length in plays:
+        keys = [("song", song_id)] + [("artist", artist_id) for artist_id in artists[song_id]]
+        if song_id in categories:
+            keys.append(("category", categories[song_id]))
+        for dimension, key_id in keys:
+            total = hourly[(hour_of(time), stream_id or 0, dimension, key_id)]
+            total[0] += 1
+            total[1] += length
+
+    daily = defaultdict(lambda: [0, timedelta(0)])
+    for (hour, stream_id, dimension, key_id), (count, airtime) in hourly.items():
+        total = daily[(hour.date(), stream_id, dimension, key_id)]
+        total[0] += count
+        total[1] += airtime
+
+    _upsert(db, HourlyPlays, "hour", hourly)
+    _upsert(db, DailyPlays, "day", daily)
+
+
+def _upsert(db, model, period, totals):
+    table = model.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[period, "stream_id", "dimension", "key_id"],
+        set_={
+            "plays": table.c.plays + statement.excluded.plays,
+            "airtime": table.c.airtime + statement.excluded.airtime,
+        },
+    )
+    db.execute(statement, [
+        {
+            period: period_start,
+            "stream_id": stream_id,
+            "dimension": dimension,
+            "key_id": key_id,
+            "plays": count,
+            "airtime": airtime,
+        }
+        for (period_start, stream_id, dimension, key_id), (count, airtime) in totals.items()
+    ])
+
+
+def catch_up(until=None):
+    """
+    Rebuild the rollups from the plays table for every whole hour since the
+    last catch up, and returns how many hours that was. The current hour is
+    left to record_plays.
+    """
+    until = hour_of(until or datetime.now())
+    rebuilt = 0
+    with session_scope() as db:
+        progress = db.query(RollupProgress).filter(RollupProgress.name == "plays").first()
+        if progress is not None:
+            start = progress.time
+        else:
+            first_play = db.query(func.min(Play.time)).scalar()
+            if first_play is None:
+                return 0
+            start = hour_of(first_play)
+        while start < until:
+            end = min(start + CATCH_UP_CHUNK, until)
+            rebuild(db, start, end)
+            db.merge(RollupProgress(name="plays", time=end))
+            db.commit()
+            rebuilt += int((end - start).total_seconds() // 3600)
+            start = end
+    return rebuilt
+
+
+def rebuild(db, start, end):
+    """
+    Replace the hourly rollups between two hours with totals from the plays
+    table, and the daily rollups for the days they're in with totals from
+    the hourly ones.
+    """
+    hourly = HourlyPlays.__table__
+    daily = DailyPlays.__table__
+
+    db.execute(hourly.delete().where(and_(hourly.c.hour >= start, hourly.c.hour < end)))
+    hour = func.date_trunc("hour", Play.time)
+    stream_id = func.coalesce(Play.stream_id, 0)
+    for dimension, key_id, query in (
+        ("song", Play.song_id, db.query()),
+        ("category", Song.category_id, db.query().select_from(Play).join(Song, Play.song_id == Song.id)),
+        ("artist", song_artists.c.artist_id, db.query().select_from(Play).join(
+            song_artists, Play.song_id == song_artists.c.song_id,
+        )),
+    ):
+        query = query.add_columns(
+            hour,
+            stream_id,
+            cast(literal(dimension), hourly.c.dimension.type),
+            key_id,
+            func.count(),
+            func.sum(Play.length),
+        ).filter(and_(Play.time >= start, Play.time < end)).group_by(hour, stream_id, key_id)
+        db.execute(hourly.insert().from_select(
+            ["hour", "stream_id", "dimension", "key_id", "plays", "airtime"], query.statement,
+        ))
+
+    first_day = start.date()
+    last_day = (end - timedelta(microseconds=1)).date()
+    db.execute(daily.delete().where(and_(daily.c.day >= first_day, daily.c.day <= last_day)))
+    day = cast(hourly.c.hour, Date)
+    db.execute(daily.insert().from_select(
+        ["day", "stream_id", "dimension", "key_id", "plays", "airtime"],
+        db.query(
+            day,
+            hourly.c.stream_id,
+            hourly.c.dimension,
+            hourly.c.key_id,
+            func.sum(hourly.c.plays),
+            func.sum(hourly.c.airtime),
+        ).filter(and_(
+            hourly.c.hour >= datetime(first_day.year, first_day.month, first_day.day),
+            hourly.c.hour < datetime(last_day.year, last_day.month, last_day.day) + timedelta(1),
+        )).group_by(
+            day, hourly.c.stream_id, hourly.c.dimension, hourly.c.key_id,
+        ).statement,
+    ))
+
+
+def top(db, dimension, first_day, last_day, limit=10):
+    """
+    Returns the most played songs, artists or categories between two days,
+    as (object, plays, airtime) tuples.
+    """
+    model = {"song": Song, "artist": Artist, "category": Category}[dimension]
+    plays = func.sum(DailyPlays.plays)
+    return db.query(model, plays, func.sum(DailyPlays.airtime)).join(
+        DailyPlays, and_(DailyPlays.dimension == dimension, DailyPlays.key_id == model.id),
+    ).filter(and_(
+        DailyPlays.day >= first_day,
+        DailyPlays.day <= last_day,
+    )).group_by(model.id).order_by(desc(plays)).limit(limit).all()
+
+
+def song_plays(db, first_day=None, last_day=None, song_ids=None):
+    """Returns a dict of song ID to how many times it played between two days."""
+    query = db.query(DailyPlays.key_id, func.sum(DailyPlays.plays)).filter(
+        DailyPlays.dimension == "song",
+    )
+    if first_day is not None:
+        query = query.filter(DailyPlays.day >= first_day)
+    if last_day is not None:
+        query = query.filter(DailyPlays.day <= last_day)
+    if song_ids is not None:
+        query = query.filter(DailyPlays.key_id.in_(song_ids))
+    return dict(query.group_by(DailyPlays.key_id))
+
+
+if __name__ == "__main__":
+    print("REBUILT %s HOURS UP TO %s" % (catch_up(), hour_of(datetime.now())))
@@ -0,0 +1,96 @@
+import json
+
+from collections import deque
+from datetime import datetime
+
+
+# Upper bounds of the histogram buckets, in milliseconds.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf"))
+
+# How many days of timing data to keep.
+KEEP_DAYS = 31
+
+# How many recent items the rolling percentiles are calculated from.
+ROLLING_SIZE = 200
+
+rolling_lateness = deque(maxlen=ROLLING_SIZE)
+rolling_slip = deque(maxlen=ROLLING_SIZE)
+
+
+def bucket(milliseconds):
+    for upper_bound in BUCKETS:
+        if milliseconds <= upper_bound:
+            return str(upper_bound)
+
+
+def histogram_percentile(histogram, percentile):
+    """
+    Returns the upper bound of the bucket containing the given percentile,
+    from a histogram of bucket to count as stored in Redis.
+    """
+    counts = [(float(upper_bound), int(count)) for upper_bound, count in histogram.items()]
+    counts.sort()
+    total = sum(count for upper_bound, count in counts)
+    if total == 0:
+        return None
+    seen = 0
+    for upper_bound, count in counts:
+        seen += count
+        if seen >= total * percentile / 100.0:
+            return upper_bound
+
+
+def bucket_label(upper_bound):
+    """Describes a bucket from histogram_percentile, like "under 5 ms"."""
+    if upper_bound is None:
+        return None
+    if upper_bound == float("inf"):
+        return "over %g ms" % BUCKETS[-2]
+    return "under %g ms" % upper_bound
+
+
+def percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * percentile / 100.0), len(values) - 1)]
+
+
+def day_key(timestamp):
+    return "timing:" + datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+
+
+async def record(redis, item_id, item_type, scheduled, started, audible, ended, slip):
+    """
+    Record how late an item started, in the daemon. Times are Unix
+    timestamps, and slip is how late the volume keyframes were applied in
+    seconds.
+    """
+
+    lateness = (started - scheduled) * 1000
+    slip = slip * 1000
+
+    key = day_key(scheduled)
+    await redis.rpush(key + ":items", json.dumps({
+        "id": item_id,
+        "type": item_type,
+        "scheduled": round(scheduled, 3),
+        "started": round(started, 3),
+        "audible": round(audible, 3) if audible is not None else None,
+        "ended": round(ended, 3),
+        "slip": round(slip, 1),
+    }, separators=(",", ":")))
+    await redis.hincrby(key + ":lateness", bucket(lateness), 1)
+    await redis.hincrby(key + ":slip", bucket(slip), 1)
+    for suffix in (":items", ":lateness", ":slip"):
+        await redis.expire(key + suffix, KEEP_DAYS * 86400)
+
+    rolling_lateness.append(lateness)
+    rolling_slip.append(slip)
+    await redis.hmset_dict("timing_summary", {
+        "count": len(rolling_lateness),
+        "lateness_p50": percentile(rolling_lateness, 50),
+        "lateness_p99": percentile(rolling_lateness, 99),
+        "slip_p50": percentile(rolling_slip, 50),
+        "slip_p99": percentile(rolling_slip, 99),
+    })
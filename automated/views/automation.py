@@ -1,80 +1,210 @@
-import time
+import json, threading
 
 from datetime import datetime, timedelta
-from flask import abort, jsonify, redirect, render_template, request, url_for
+from flask import Response, jsonify, render_template, request, stream_with_context
 from redis import StrictRedis
-from sqlalchemy.orm import joinedload
-from sqlalchemy.orm.exc import NoResultFound
 
-from automated.db import Session, Song, WeeklyEvent
+redis = StrictRedis(decode_responses=True)
+
+# How often to send something to idle streams, so proxies don't close them.
+KEEPALIVE_INTERVAL = 30
+
+
+class Broadcaster(object):
+    """
+    Listens to a Redis channel from one background thread per process, and
+    wakes up every request which is waiting for a message. This means
+    clients don't each need their own subscription.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.condition = threading.Condition()
+        self.count = 0
+        self.thread = None
+
+    def start(self):
+        # Start the thread lazily, because gunicorn forks after importing.
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.listen, daemon=True)
+                self.thread.start()
+
+    def listen(self):
+        ps = redis.pubsub()
+        ps.subscribe(self.channel)
+        for m in ps.listen():
+            if m["type"] == "message":
+                with self.condition:
+                    self.count += 1
+                    self.condition.notify_all()
+
+    def wait(self, last_count, timeout=None):
+        """
+        Wait until there's been a message since `last_count`, and return the
+        new count. Returns `last_count` if the timeout runs out.
+        """
+        self.start()
+        with self.condition:
+            self.condition.wait_for(lambda: self.count != last_count, timeout)
+            return self.count
+
+
+updates = Broadcaster("update")
+
+
+def get_snapshot():
+    # The automation daemon keeps a snapshot of the play queue in Redis, with
+    # everything we need to display it.
+    snapshot = redis.get("queue_snapshot")
+    return json.loads(snapshot) if snapshot is not None else {"items": []}
 
-redis = StrictRedis()
 
 def automation():
     alive = redis.get("automation_pid") is not None
     running = redis.get("running") is not None
     play_queue = []
-    for item_id, timestamp in redis.zrange("play_queue", 0, -1, withscores=True):
-        item = redis.hgetall("item:"+item_id)
+    for item in get_snapshot()["items"]:
         if "length" in item:
-            item["length"] = timedelta(0, float(item["length"]))
-        song = None
-        if item["type"] == "song":
-            song = Session.query(Song).filter(
-                Song.id==int(item["song_id"])
-            ).options(
-                joinedload(Song.artists),
-                joinedload(Song.category),
-            ).one()
-        else:
-            event = Session.query(WeeklyEvent).filter(
-                WeeklyEvent.id==int(item["event_id"]),
-            ).one()
-        play_queue.append((datetime.fromtimestamp(timestamp), item, song or event))
+            item["length"] = timedelta(0, item["length"])
+        play_queue.append((datetime.fromtimestamp(item["time"]), item))
     return render_template(
         "automation.html",
         section="automation",
         alive=alive,
         running=running,
         play_queue=play_queue,
+        timing_summary={
+            key: float(value)
+            for key, value in redis.hgetall("timing_summary").items()
+        },
     )
 
 
+def item_view(item):
+    item_dict = {
+        "id": item["id"],
+        "timestamp": item["time"],
+        "status": item["status"],
+        "time": datetime.fromtimestamp(item["time"]).strftime("%H:%M:%S"),
+        "name": item.get("name", ""),
+    }
+    if "length" in item:
+        item_dict["length"] = str(timedelta(0, item["length"]))
+    item_dict["artist"] = ""
+    if item["type"] == "song":
+        if item.get("artist"):
+            item_dict["artist"] += "Artist: " + item["artist"] + ", "
+        item_dict["artist"] += "Category: " + item.get("category", "")
+    else:
+        item_dict["artist"] = item.get("artist", "")
+    return item_dict
+
+
+# Stream messages by version, so each one is only built once however many
+# clients are connected.
+messages = {}
+
+# How many deltas the daemon keeps, the same as MAX_DELTAS in
+# helpers/snapshot.py.
+KEEP_DELTAS = 100
+messages_lock = threading.Lock()
+
+
+def snapshot_message(snapshot):
+    key = ("snapshot", snapshot.get("version"))
+    with messages_lock:
+        if key not in messages:
+            # Only the latest snapshot is worth keeping.
+            for old_key in [_ for _ in messages if _[0] == "snapshot"]:
+                del messages[old_key]
+            messages[key] = "id: %s\nevent: snapshot\ndata: %s\n\n" % (
+                snapshot.get("version", ""),
+                json.dumps({"play_queue": [item_view(item) for item in snapshot["items"]]}),
+            )
+        return messages[key]
+
+
+def delta_messages(from_version, to_version):
+    """
+    Returns the messages to bring a client from one version to another, or
+    None if some of the deltas are no longer kept.
+    """
+    wanted = range(from_version + 1, to_version + 1)
+    with messages_lock:
+        missing = [version for version in wanted if ("delta", version) not in messages]
+    if missing:
+        # Deltas are kept in order of version, so the ones we're missing are
+        # at the end. More may have been added since, so fetch further back
+        # if the first one isn't far enough.
+        count = to_version - missing[0] + 1
+        deltas = [json.loads(delta) for delta in redis.lrange("queue_deltas", -count, -1)]
+        if deltas and deltas[0]["version"] > missing[0]:
+            count += deltas[0]["version"] - missing[0]
+            deltas = [json.loads(delta) for delta in redis.lrange("queue_deltas", -count, -1)]
+        missing = set(missing)
+        with messages_lock:
+            for delta in deltas:
+                if delta["version"] not in missing:
+                    continue
+                messages[("delta", delta["version"])] = "id: %s\nevent: delta\ndata: %s\n\n" % (
+                    delta["version"],
+                    json.dumps({
+                        "inserted": [item_view(item) for item in delta["inserted"]],
+                        "removed": delta["removed"],
+                        "changed": delta["changed"],
+                    }),
+                )
+            # Forget messages which have also dropped out of Redis.
+            for key in list(messages):
+                if key[1] is None or key[1] <= to_version - KEEP_DELTAS:
+                    del messages[key]
+    with messages_lock:
+        if any(("delta", version) not in messages for version in wanted):
+            return None
+        return [messages[("delta", version)] for version in wanted]
+
+
+def messages_since(version):
+    snapshot = get_snapshot()
+    current = snapshot.get("version")
+    if version is None or current is None or version > current:
+        return current, [snapshot_message(snapshot)]
+    deltas = delta_messages(version, current)
+    if deltas is None:
+        # Too far behind, so start again from the whole queue.
+        return current, [snapshot_message(snapshot)]
+    return current, deltas
+
+
 def update():
-    ps = redis.pubsub()
-    ps.subscribe("update")
-    for m in ps.listen():
-        if m["type"] == "message":
-            break
-    play_queue = []
-    for item_id, timestamp in redis.zrange("play_queue", 0, -1, withscores=True):
-        item = redis.hgetall("item:"+item_id)
-        item_dict = {
-            "status": item["status"],
-            "time": datetime.fromtimestamp(timestamp).strftime("%H:%M:%S"),
-        }
-        if "length" in item:
-            item_dict["length"] = str(timedelta(0, float(item["length"])))
-        if item["type"] == "song":
-            song = Session.query(Song).filter(
-                Song.id==int(item["song_id"])
-            ).options(
-                joinedload(Song.artists),
-                joinedload(Song.category),
-            ).one()
-            item_dict["name"] = song.name
-            item_dict["artist"] = ""
-            if song.artists:
-                item_dict["artist"] += "Artist: "
-                for artist in song.artists:
-                    item_dict["artist"] += artist.name + ", "
-            item_dict["artist"] += "Category: " + song.category.name
-        else:
-            event = Session.query(WeeklyEvent).filter(
-                WeeklyEvent.id==int(item["event_id"]),
-            ).one()
-            item_dict["name"] = event.name
-            item_dict["artist"] = event.type + " event"
-        play_queue.append(item_dict)
-    return jsonify({ "play_queue": play_queue })
+    updates.wait(updates.count, KEEPALIVE_INTERVAL)
+    return jsonify({ "play_queue": [item_view(item) for item in get_snapshot()["items"]] })
+
 
+def stream():
+    # Browsers send the ID of the last message they saw when they reconnect.
+    try:
+        version = int(request.headers["Last-Event-ID"])
+    except (KeyError, ValueError):
+        version = None
+
+    def events(version):
+        count = updates.count
+        while True:
+            version, pending = messages_since(version)
+            for message in pending:
+                yield message
+            new_count = updates.wait(count, KEEPALIVE_INTERVAL)
+            if new_count == count:
+                yield ": keepalive\n\n"
+            count = new_count
+
+    # Streams stay open for as long as the page does, so they're meant to be
+    # served by gevent workers, where each one is a greenlet rather than a
+    # thread. See the README.
+    return Response(
+        stream_with_context(events(version)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,23 +1,35 @@
-import tempfile
+import io, json, time
 
 from csv import writer
 from datetime import date, datetime, timedelta
-from flask import abort, make_response, render_template, request, url_for
+from flask import Response, abort, render_template, request, stream_with_context, url_for
+from redis import StrictRedis
 from sqlalchemy import and_
 from sqlalchemy.orm import joinedload_all
 from sqlalchemy.orm.exc import NoResultFound
 
-from automated.db import Session, Play
+from automated import rollups, timing
+from automated.db import Session, Artist, Category, Play, Song, song_artists
+
+redis = StrictRedis(decode_responses=True)
+
+# How many plays to fetch from the database at a time when exporting.
+EXPORT_BATCH_SIZE = 1000
+
+
+def parse_date(value):
+    day, month, year = value.split("/")
+    year = int(year)
+    # strftime doesn't like years before 1900
+    if year<1900:
+        raise ValueError
+    return date(int(year), int(month), int(day))
+
 
 def log():
     if "date" in request.values and request.values["date"]!="":
         try:
-            day, month, year = request.values["date"].split("/")
-            year = int(year)
-            # strftime doesn't like years before 1900
-            if year<1900:
-                raise ValueError
-            current_date = date(int(year), int(month), int(day))
+            current_date = parse_date(request.values["date"])
         except ValueError:
             return "Please enter a date in the form dd/mm/yyyy.", 400
     else:
@@ -30,35 +42,148 @@ def log():
         current_date.day
     )
     max_datetime = min_datetime + timedelta(1)
-    plays = Session.query(Play).filter(and_(
-        Play.time>=min_datetime,
-        Play.time<max_datetime,
-    )).options(
-        joinedload_all("song.category"),
-        joinedload_all("song.artists"),
-    ).order_by(Play.time).all()
-    if "format" in request.values and request.values["format"]=="csv":
-        with tempfile.TemporaryFile("w+b") as f:
-            csv = writer(f, dialect="excel")
-            csv.writerow(("time", "title", "artist"))
-            for play in plays:
-                csv.writerow((
-                    play.time.strftime("%H:%M:%S"),
-                    play.song.name,
-                    ", ".join(_.name for _ in play.song.artists),
-                ))
-            f.seek(0)
-            response = make_response(f.read())
-            response.headers["Content-Disposition"] = (
-                "attachment; filename=automation_%s_%s_%s.csv"
-                % (current_date.year, current_date.month, current_date.day)
-            )
-            return response
+    if "format" in request.values and request.values["format"] in EXPORT_FORMATS:
+        return export_response(
+            min_datetime, max_datetime, request.values["format"],
+            "automation_%s_%s_%s" % (current_date.year, current_date.month, current_date.day),
+        )
     else:
+        plays = Session.query(Play).filter(and_(
+            Play.time>=min_datetime,
+            Play.time<max_datetime,
+        )).options(
+            joinedload_all("song.category"),
+            joinedload_all("song.artists"),
+        ).order_by(Play.time).all()
+        timing_key = timing.day_key(time.mktime(min_datetime.timetuple()))
+        lateness = redis.hgetall(timing_key + ":lateness")
+        slip = redis.hgetall(timing_key + ":slip")
         return render_template(
             "log.html",
             section="log",
             current_date=current_date,
             log=plays,
+            top_categories=rollups.top(Session, "category", current_date, current_date, limit=None),
+            top_artists=rollups.top(Session, "artist", current_date, current_date),
+            lateness_p50=timing.bucket_label(timing.histogram_percentile(lateness, 50)),
+            lateness_p99=timing.bucket_label(timing.histogram_percentile(lateness, 99)),
+            slip_p99=timing.bucket_label(timing.histogram_percentile(slip, 99)),
         )
 
+
+def export():
+    try:
+        start_date = parse_date(request.values["start"])
+        end_date = parse_date(request.values["end"])
+    except (KeyError, ValueError):
+        return "Please enter the start and end dates in the form dd/mm/yyyy.", 400
+    if end_date < start_date:
+        return "The end date must not be before the start date.", 400
+    export_format = request.values.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    return export_response(
+        datetime(start_date.year, start_date.month, start_date.day),
+        datetime(end_date.year, end_date.month, end_date.day) + timedelta(1),
+        export_format,
+        "automation_%s_to_%s" % (start_date.isoformat(), end_date.isoformat()),
+    )
+
+
+def export_response(min_datetime, max_datetime, export_format, filename):
+    """
+    Stream every play in a date range as it's read from the database, so
+    long ranges don't need to fit in memory.
+    """
+    mimetype, generate = EXPORT_FORMATS[export_format]
+    response = Response(
+        stream_with_context(generate(export_rows(min_datetime, max_datetime))),
+        mimetype=mimetype,
+    )
+    response.headers["Content-Disposition"] = (
+        "attachment; filename=%s.%s" % (filename, export_format)
+    )
+    return response
+
+
+def export_rows(min_datetime, max_datetime):
+    """
+    Yields (time, title, artists, category, length) for each play. Rows are
+    read with a server-side cursor, and artists are looked up for a batch
+    of plays at a time.
+    """
+    plays = Session.query(
+        Play.time, Play.length, Song.id, Song.name, Category.name,
+    ).join(Song, Play.song_id==Song.id).join(Category).filter(and_(
+        Play.time>=min_datetime,
+        Play.time<max_datetime,
+    )).order_by(Play.time).execution_options(
+        stream_results=True,
+    ).yield_per(EXPORT_BATCH_SIZE)
+
+    # Song ID to artist names. Most songs are played many times, so this
+    # saves looking them up again in every batch.
+    artists = {}
+    batch = []
+    for play in plays:
+        batch.append(play)
+        if len(batch) == EXPORT_BATCH_SIZE:
+            for row in _export_batch(batch, artists):
+                yield row
+            batch = []
+    for row in _export_batch(batch, artists):
+        yield row
+
+
+def _export_batch(batch, artists):
+    song_ids = set(song_id for play_time, length, song_id, name, category in batch) - set(artists)
+    if song_ids:
+        for song_id in song_ids:
+            artists[song_id] = []
+        for song_id, artist_name in Session.query(
+            song_artists.c.song_id, Artist.name,
+        ).join(Artist, song_artists.c.artist_id==Artist.id).filter(
+            song_artists.c.song_id.in_(song_ids),
+        ).order_by(Artist.name):
+            artists[song_id].append(artist_name)
+    for play_time, length, song_id, name, category in batch:
+        yield play_time, name, ", ".join(artists[song_id]), category, length
+
+
+def generate_csv(rows):
+    line = io.StringIO()
+    csv = writer(line, dialect="excel")
+    csv.writerow(("date", "time", "title", "artist", "category", "length"))
+    yield line.getvalue()
+    for play_time, name, artist, category, length in rows:
+        line.seek(0)
+        line.truncate()
+        csv.writerow((
+            play_time.strftime("%Y-%m-%d"),
+            play_time.strftime("%H:%M:%S"),
+            name,
+            artist,
+            category,
+            length.total_seconds(),
+        ))
+        yield line.getvalue()
+
+
+def generate_json(rows):
+    separator = "[\n"
+    for play_time, name, artist, category, length in rows:
+        yield separator + json.dumps({
+            "time": play_time.isoformat(),
+            "title": name,
+            "artist": artist,
+            "category": category,
+            "length": length.total_seconds(),
+        })
+        separator = ",\n"
+    yield "[]\n" if separator == "[\n" else "\n]\n"
+
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", generate_csv),
+    "json": ("application/json", generate_json),
+}
@@ -0,0 +1,28 @@
+from flask import Response
+from redis import StrictRedis
+
+from automated.metrics import Histogram, registry
+
+redis = StrictRedis(decode_responses=True)
+
+request_seconds = Histogram("automated_web_request_seconds", "Time taken to handle a web request.")
+
+
+def metrics():
+    output = [registry.render()]
+
+    # The automation daemon publishes its own metrics to Redis.
+    automation_metrics = redis.get("metrics:automation")
+    if automation_metrics:
+        output.append(automation_metrics)
+
+    # Redis counts commands itself, so use that rather than counting them in
+    # each process.
+    output.append("# HELP automated_redis_commands_total Number of commands processed by Redis.\n")
+    output.append("# TYPE automated_redis_commands_total counter\n")
+    for name, stats in sorted(redis.info("commandstats").items()):
+        output.append('automated_redis_commands_total{command="%s"} %s\n' % (
+            name.replace("cmdstat_", ""), stats["calls"],
+        ))
+
+    return Response("".join(output), mimetype="text/plain; version=0.0.4")
@@ -1,11 +1,13 @@
-from datetime import timedelta
-from flask import abort, redirect, render_template, request, url_for
-from pydub import AudioSegment
+import os, tempfile
+
+from datetime import date, timedelta
+from flask import abort, redirect, render_template, request, send_file, url_for
 from sqlalchemy import func
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug import secure_filename
 
+from automated import probe, rollups, waveform
 from automated.db import Session, Artist, Category, Song, string_to_timedelta
 
 def playlist(category_id=None):
@@ -27,6 +29,7 @@ def playlist(category_id=None):
         all_categories=all_categories,
         current_category=current_category,
         songs=songs,
+        recent_plays=rollups.song_plays(Session, first_day=date.today() - timedelta(29)),
     )
 
 def new_category():
@@ -42,6 +45,7 @@ def song(song_id):
         song = Session.query(Song).filter(Song.id==song_id).options(
             joinedload(Song.category),
             joinedload(Song.artists),
+            joinedload(Song.analysis),
         ).one()
     except NoResultFound:
         abort(404)
@@ -51,9 +55,26 @@ def song(song_id):
         section="playlist",
         all_categories=all_categories,
         song=song,
-        artist_names=", ".join(_.name for _ in song.artists)
+        artist_names=", ".join(_.name for _ in song.artists),
+        plays_today=rollups.song_plays(Session, first_day=date.today(), song_ids=[song.id]).get(song.id, 0),
+        plays_month=rollups.song_plays(Session, first_day=date.today() - timedelta(29), song_ids=[song.id]).get(song.id, 0),
+        plays_total=rollups.song_plays(Session, song_ids=[song.id]).get(song.id, 0),
     )
 
+def song_waveform(song_id):
+    metadata_path, level_path = waveform.paths(song_id)
+    if not os.path.exists(metadata_path):
+        abort(404)
+    return send_file(os.path.abspath(metadata_path), mimetype="application/json", conditional=True)
+
+def song_waveform_level(song_id, level):
+    # Levels are served with range support so the browser can fetch just the
+    # part it's showing.
+    metadata_path, level_path = waveform.paths(song_id)
+    if not os.path.exists(level_path(level)):
+        abort(404)
+    return send_file(os.path.abspath(level_path(level)), mimetype="application/octet-stream", conditional=True)
+
 def edit_song(song_id):
 
     try:
@@ -95,8 +116,10 @@ def edit_song(song_id):
 
     end = request.form["end"].strip()
     if len(end)==0:
-        segment = AudioSegment.from_file("songs/"+song.filename)
-        song.end = timedelta(0, segment.duration_seconds)
+        try:
+            song.end = timedelta(0, probe.probe("songs/"+song.filename).duration)
+        except probe.ProbeError:
+            return "Couldn't read the length of this song's file. Please enter an end point.", 400
     else:
         try:
             song.end = string_to_timedelta(end)
@@ -141,25 +164,32 @@ def new_song():
     if len(name)==0:
         return "Please enter a title.", 400
 
-    song_file = request.files["file"]
-    try:
-        segment = AudioSegment.from_file(song_file)
-    except:
-        return "That doesn't appear to be a valid audio file. Accepted formats are WAV, MP3 and OGG.", 400
-
     try:
         category = Session.query(Category).filter(Category.id==request.form["category_id"]).one()
     except (ValueError, NoResultFound):
         return "Invalid category.", 400
 
+    # Save the upload straight away so it can be probed without reading it
+    # into memory, and moved into place once we know the song ID.
+    song_file = request.files["file"]
+    fd, upload_path = tempfile.mkstemp(dir="songs", prefix="upload_")
+    os.close(fd)
+    song_file.save(upload_path)
+    try:
+        info = probe.probe(upload_path)
+    except probe.ProbeError:
+        os.remove(upload_path)
+        return "That doesn't appear to be a valid audio file. Accepted formats are WAV, MP3 and OGG.", 400
+
     # Default to not having a start point for now because that's fine for most songs.
     length = request.form["length"].strip()
     if len(length)==0:
-        length = timedelta(0, segment.duration_seconds)
+        length = timedelta(0, info.duration)
     else:
         try:
             length = string_to_timedelta(length)
         except ValueError:
+            os.remove(upload_path)
             return "Please enter a length in the form MM:SS.", 400
 
     song = Song(
@@ -185,8 +215,7 @@ def new_song():
         song.artists.append(artist)
 
     song.filename=("%s_%s" % (song.id, secure_filename(song_file.filename)))[:100]
-    song_file.seek(0)
-    song_file.save("songs/"+song.filename)
+    os.rename(upload_path, "songs/"+song.filename)
 
     return redirect(request.headers["Referer"])
 
@@ -1,13 +1,15 @@
+import os, tempfile
+
 from collections import defaultdict
 from datetime import time, timedelta
 from flask import Flask, abort, redirect, render_template, request, url_for
-from pydub import AudioSegment
 from redis import StrictRedis
 from sqlalchemy import and_
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug import secure_filename
 
+from automated import probe
 from automated.db import (
     Session,
     Category,
@@ -21,6 +23,12 @@ from automated.db import (
 
 redis = StrictRedis()
 
+
+def schedule_changed():
+    # Commit first so the daemon sees the change as soon as it wakes up.
+    Session.commit()
+    redis.publish("schedule", "changed")
+
 # Sequence schedule
 
 def schedule():
@@ -83,6 +91,7 @@ def edit_schedule():
     for hour in schedule_range:
         Session.add(ScheduleHour(day=day, hour=hour, sequence_id=sequence.id))
 
+    schedule_changed()
     return redirect(url_for("schedule"))
 
 # Sequences
@@ -133,6 +142,7 @@ def add_sequence_item(sequence_id):
         number=items[-1].number+1 if len(items)!=0 else 1,
         category=category,
     ))
+    schedule_changed()
     return redirect(url_for("sequence", sequence_id=sequence.id))
 
 def remove_sequence_item(sequence_id):
@@ -140,6 +150,7 @@ def remove_sequence_item(sequence_id):
         SequenceItem.sequence_id==sequence_id,
         SequenceItem.number==int(request.form["number"]),
     )).delete()
+    schedule_changed()
     return redirect(url_for("sequence", sequence_id=sequence_id))
 
 def replace_sequence_items(sequence_id):
@@ -167,6 +178,7 @@ def replace_sequence_items(sequence_id):
             number=number,
             category=category,
         ))
+    schedule_changed()
     return "", 204
 
 # Limits
@@ -194,6 +206,7 @@ def save_limits():
         )
     except ValueError:
         return "Please enter a time in the form hh:mm:ss.", 400
+    schedule_changed()
     return redirect(url_for("limits"))
 
 # Events
@@ -260,18 +273,23 @@ def new_event():
     if request.form["type"]=="audio":
 
         event_file = request.files["file"]
+        fd, upload_path = tempfile.mkstemp(dir="events", prefix="upload_")
+        os.close(fd)
+        event_file.save(upload_path)
         try:
-            segment = AudioSegment.from_file(event_file)
-        except:
+            info = probe.probe(upload_path)
+        except probe.ProbeError:
+            os.remove(upload_path)
             return "That doesn't appear to be a valid audio file. Accepted formats are WAV, MP3 and OGG.", 400
 
         length = request.form["length"].strip()
         if len(length)==0:
-            length = timedelta(0, segment.duration_seconds)
+            length = timedelta(0, info.duration)
         else:
             try:
                 length = string_to_timedelta(length)
             except ValueError:
+                os.remove(upload_path)
                 return "Please enter a length in the form MM:SS.", 400
 
     event = WeeklyEvent(
@@ -287,12 +305,13 @@ def new_event():
     if request.form["type"]=="audio":
         event.length = length
         event.filename = ("%s_%s" % (event.id, secure_filename(event_file.filename)))[:100]
-        event_file.seek(0)
-        event_file.save("events/"+event.filename)
+        os.rename(upload_path, "events/"+event.filename)
 
+    schedule_changed()
     return redirect(request.headers["Referer"])
 
 def delete_event(event_id):
     Session.query(WeeklyEvent).filter(WeeklyEvent.id==event_id).delete()
+    schedule_changed()
     return redirect(request.headers["Referer"])
 
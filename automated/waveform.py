@@ -0,0 +1,76 @@
+import json, os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Where waveform files are kept, next to songs/.
+WAVEFORM_PATH = "waveforms"
+
+# Samples per bucket at the most detailed level. Each level after that has
+# buckets this many times bigger.
+BASE_BUCKET = 256
+LEVEL_FACTOR = 4
+
+# Levels stop once they'd have fewer buckets than this.
+MIN_BUCKETS = 64
+
+
+def paths(song_id, waveform_path=WAVEFORM_PATH):
+    """
+    Returns the path of a song's metadata file and a function giving the
+    path of each level. Levels are raw little-endian int16 (min, max) pairs,
+    so they can be memory mapped or read a range at a time.
+    """
+    base = os.path.join(waveform_path, str(song_id))
+    return base + ".json", lambda level: "%s_%s.i16" % (base, level)
+
+
+def build(song_id, samples, sample_rate, waveform_path=WAVEFORM_PATH):
+    """
+    Write the peak pyramid for a song from its mono samples, as a NumPy
+    float array between -1 and 1.
+    """
+    os.makedirs(waveform_path, exist_ok=True)
+    metadata_path, level_path = paths(song_id, waveform_path)
+
+    scaled = numpy.clip(samples * 32767, -32768, 32767).astype(numpy.int16)
+    buckets = -(-len(scaled) // BASE_BUCKET)
+    # Pad the last bucket with its own last sample so it doesn't add a peak.
+    padded = numpy.empty(buckets * BASE_BUCKET, dtype=numpy.int16)
+    padded[:len(scaled)] = scaled
+    padded[len(scaled):] = scaled[-1] if len(scaled) else 0
+    padded = padded.reshape(buckets, BASE_BUCKET)
+    peaks = numpy.stack((padded.min(axis=1), padded.max(axis=1)), axis=1)
+
+    levels = []
+    bucket = BASE_BUCKET
+    while True:
+        _write(level_path(len(levels)), peaks.astype("<i2").tobytes())
+        levels.append({"bucket": bucket, "count": len(peaks)})
+        if len(peaks) // LEVEL_FACTOR < MIN_BUCKETS:
+            break
+        # Each level is made from the one before, not from the samples.
+        groups = -(-len(peaks) // LEVEL_FACTOR)
+        grouped = numpy.empty((groups * LEVEL_FACTOR, 2), dtype=numpy.int16)
+        grouped[:len(peaks)] = peaks
+        grouped[len(peaks):] = peaks[-1]
+        grouped = grouped.reshape(groups, LEVEL_FACTOR, 2)
+        peaks = numpy.stack((grouped[:, :, 0].min(axis=1), grouped[:, :, 1].max(axis=1)), axis=1)
+        bucket *= LEVEL_FACTOR
+
+    _write(metadata_path, json.dumps({
+        "sample_rate": sample_rate,
+        "duration": len(samples) / float(sample_rate),
+        "levels": levels,
+    }).encode("utf-8"))
+
+
+def _write(path, data):
+    # Write to a temporary file first, so nobody reads half a file.
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(data)
+    os.replace(temporary_path, path)
@@ -0,0 +1,73 @@
+"""
+Compares the fit allocation policies against the old one-second-at-a-time
+shorten() loop. Run with `python benchmarks/fit_benchmark.py`.
+"""
+
+import os, random, sys, timeit
+
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from automated.helpers.fit import fit, POLICIES
+
+
+class FakeSong(object):
+    def __init__(self, min_length, max_length):
+        self.min_length = min_length
+        self.max_length = max_length
+
+
+def old_shorten(songs, distance, error_margin):
+    while distance > error_margin:
+        for song in songs:
+            shorten_by = min(
+                distance,
+                song[1] - song[0].min_length,
+                timedelta(0, 1),
+            )
+            song[1] -= shorten_by
+            distance -= shorten_by
+    return songs
+
+
+def make_plan(song_count, distance):
+    # Songs with 10 to 60 seconds of room each, with at least enough room
+    # overall that the old loop will finish.
+    while True:
+        songs = []
+        for n in range(song_count):
+            length = timedelta(0, random.uniform(150, 300))
+            songs.append([FakeSong(length - timedelta(0, random.uniform(10, 60)), length), length])
+        if sum((song[1] - song[0].min_length for song in songs), timedelta(0)) > distance:
+            return songs
+
+
+def main():
+    random.seed(0)
+    error_margin = timedelta(0, 2)
+    print("%6s %9s %12s %s" % ("songs", "distance", "old loop", " ".join("%14s" % _ for _ in POLICIES)))
+    for song_count in (5, 10, 20, 50):
+        for minutes in (1, 3, 5):
+            distance = timedelta(0, minutes * 60)
+            if song_count * 60 <= distance.total_seconds():
+                continue
+            plan = make_plan(song_count, distance)
+            number = 20
+
+            def copy():
+                return [[song, length] for song, length in plan]
+
+            results = [timeit.timeit(lambda: old_shorten(copy(), distance, error_margin), number=number)]
+            for policy in POLICIES:
+                results.append(timeit.timeit(lambda: fit(copy(), -distance, error_margin, policy), number=number))
+            print("%6d %9s %10.3fms %s" % (
+                song_count,
+                distance,
+                results[0] / number * 1000,
+                " ".join("%12.3fms" % (_ / number * 1000) for _ in results[1:]),
+            ))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ setup(
     install_requires=[
         "aioredis",
         "flask",
+        "gevent",
         "gunicorn",
         "psycopg2",
         "pydub",
@@ -22,9 +23,14 @@ setup(
         "redis",
         "sqlalchemy",
     ],
+    extras_require={
+        "analysis": ["numpy"],
+        "dev": ["pyflakes", "pytest"],
+        "probe": ["mutagen"],
+    },
     entry_points="""\
         [console_scripts]
-        automated = automated.automation
+        automated = automated.cli:main
     """,
 )
 
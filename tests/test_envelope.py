@@ -0,0 +1,45 @@
+import unittest
+
+try:
+    from automated.helpers.envelope import volume_curve
+except ImportError:
+    # The envelope module needs python-vlc.
+    volume_curve = None
+
+
+@unittest.skipIf(volume_curve is None, "python-vlc isn't installed")
+class VolumeCurveTest(unittest.TestCase):
+
+    def test_fade_up(self):
+        self.assertEqual(
+            volume_curve([(0, 0), (4, 4)]),
+            [(0, 0), (1, 1), (2, 2), (3, 3), (4, 4)],
+        )
+
+    def test_fade_down(self):
+        self.assertEqual(
+            volume_curve([(10, 100), (11, 98)]),
+            [(10, 100), (10.5, 99), (11, 98)],
+        )
+
+    def test_flat(self):
+        # Nothing changes in between, so there's nothing to add.
+        self.assertEqual(volume_curve([(0, 50), (30, 50)]), [(0, 50), (30, 50)])
+
+    def test_single_keyframe(self):
+        self.assertEqual(volume_curve([(5, 100)]), [(5, 100)])
+
+    def test_several_keyframes(self):
+        curve = volume_curve([(0, 0), (2, 2), (10, 2), (11, 0)])
+        self.assertEqual(curve, [(0, 0), (1, 1), (2, 2), (10, 2), (10.5, 1), (11, 0)])
+
+    def test_one_step_at_a_time(self):
+        curve = volume_curve([(0, 0), (1, 100), (3, 20)])
+        for (time, volume), (next_time, next_volume) in zip(curve, curve[1:]):
+            self.assertTrue(time <= next_time)
+            self.assertEqual(abs(next_volume - volume), 1)
+        self.assertEqual(len(curve), 1 + 100 + 80)
+
+
+if __name__ == "__main__":
+    unittest.main()
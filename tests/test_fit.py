@@ -0,0 +1,79 @@
+import unittest
+
+from datetime import timedelta
+
+from automated.helpers.fit import fit, CannotFit, POLICIES
+
+
+class Song(object):
+    def __init__(self, length, min_length, max_length):
+        self.length = timedelta(0, length)
+        self.min_length = timedelta(0, min_length)
+        self.max_length = timedelta(0, max_length)
+
+
+def plan(*songs):
+    return [[song, song.length] for song in songs]
+
+
+def total(songs):
+    return sum((length for song, length in songs), timedelta(0))
+
+
+class FitTest(unittest.TestCase):
+
+    def assertWithinLimits(self, songs):
+        for song, length in songs:
+            self.assertTrue(song.min_length <= length <= song.max_length)
+
+    def test_every_policy_fits(self):
+        for policy in POLICIES:
+            for change in (timedelta(0, -25), timedelta(0, 25), timedelta(0, 10, 333333)):
+                songs = plan(Song(200, 180, 220), Song(180, 175, 200), Song(240, 220, 250))
+                before = total(songs)
+                fit(songs, change, timedelta(0), policy)
+                self.assertEqual(total(songs) - before, change, policy)
+                self.assertWithinLimits(songs)
+
+    def test_no_change(self):
+        songs = plan(Song(200, 180, 220))
+        fit(songs, timedelta(0), timedelta(0))
+        self.assertEqual(songs[0][1], timedelta(0, 200))
+
+    def test_proportional(self):
+        songs = plan(Song(200, 190, 200), Song(200, 170, 200))
+        fit(songs, timedelta(0, -20), timedelta(0), "proportional")
+        self.assertEqual([length for song, length in songs], [timedelta(0, 195), timedelta(0, 185)])
+
+    def test_water_filling(self):
+        # The first song runs out of room, so the second takes the rest.
+        songs = plan(Song(200, 195, 200), Song(200, 170, 200))
+        fit(songs, timedelta(0, -20), timedelta(0), "water_filling")
+        self.assertEqual([length for song, length in songs], [timedelta(0, 195), timedelta(0, 185)])
+
+    def test_prefer_last(self):
+        songs = plan(Song(200, 180, 220), Song(200, 190, 220))
+        fit(songs, timedelta(0, -15), timedelta(0), "prefer_last")
+        self.assertEqual([length for song, length in songs], [timedelta(0, 195), timedelta(0, 190)])
+
+    def test_within_error_margin(self):
+        # Not enough room for all of it, but close enough.
+        songs = plan(Song(200, 190, 200), Song(200, 190, 200))
+        fit(songs, timedelta(0, -22), timedelta(0, 5))
+        self.assertEqual(total(songs), timedelta(0, 380))
+
+    def test_cannot_fit(self):
+        songs = plan(Song(200, 190, 200), Song(200, 190, 200))
+        with self.assertRaises(CannotFit):
+            fit(songs, timedelta(0, -30), timedelta(0, 5))
+        # Nothing is changed.
+        self.assertEqual([length for song, length in songs], [timedelta(0, 200), timedelta(0, 200)])
+
+    def test_cannot_lengthen_past_max(self):
+        songs = plan(Song(200, 180, 200))
+        with self.assertRaises(CannotFit):
+            fit(songs, timedelta(0, 10), timedelta(0, 5))
+
+
+if __name__ == "__main__":
+    unittest.main()
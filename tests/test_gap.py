@@ -0,0 +1,100 @@
+import random, unittest
+
+from collections import namedtuple
+from datetime import timedelta
+
+from automated.helpers.gap import fill_gap
+
+
+Artist = namedtuple("Artist", ("id",))
+
+
+class Song(object):
+    def __init__(self, id, length, artists, room=10):
+        self.id = id
+        self.length = timedelta(0, length)
+        self.min_length = timedelta(0, length - room)
+        self.max_length = timedelta(0, length + room)
+        self.artists = [Artist(_) for _ in artists]
+
+
+def repeating(categories):
+    while True:
+        for category in categories:
+            yield category
+
+
+class FillGapTest(unittest.TestCase):
+
+    def assertDistinct(self, songs):
+        song_ids = [song.id for song, length in songs]
+        artist_ids = [artist.id for song, length in songs for artist in song.artists]
+        self.assertEqual(len(song_ids), len(set(song_ids)))
+        self.assertEqual(len(artist_ids), len(set(artist_ids)))
+
+    def assertWithinLimits(self, songs):
+        for song, length in songs:
+            self.assertTrue(song.min_length <= length <= song.max_length)
+
+    def test_exact(self):
+        songs = {1: [Song(n, 200 + n, [n]) for n in range(10)]}
+        result = fill_gap(repeating([1]), songs.get, timedelta(0, 1000), timedelta(0, 2))
+        self.assertIsNotNone(result)
+        chosen, slots_used, distance = result
+        self.assertTrue(abs(distance) <= timedelta(0, 2))
+        self.assertDistinct(chosen)
+        self.assertWithinLimits(chosen)
+
+    def test_backtracks_past_repeated_artists(self):
+        # Lots of songs share an artist, so choosing greedily runs into
+        # repeats.
+        rng = random.Random(1)
+        for attempt in range(100):
+            songs = {}
+            song_id = 0
+            for category in range(3):
+                songs[category] = []
+                for n in range(rng.randint(1, 15)):
+                    songs[category].append(Song(song_id, rng.randint(150, 300), [rng.randint(0, 12)]))
+                    song_id += 1
+            result = fill_gap(repeating([0, 1, 2]), songs.get, timedelta(0, rng.randint(600, 1500)), timedelta(0, 5))
+            if result is not None:
+                self.assertDistinct(result[0])
+                self.assertWithinLimits(result[0])
+
+    def test_twelve_songs_per_category(self):
+        songs = {
+            category: [Song(category * 12 + n, 180 + 7 * n, [category * 12 + n]) for n in range(12)]
+            for category in range(3)
+        }
+        result = fill_gap(repeating([0, 1, 2]), songs.get, timedelta(0, 2400), timedelta(0, 5))
+        self.assertIsNotNone(result)
+        chosen, slots_used, distance = result
+        self.assertTrue(abs(distance) <= timedelta(0, 5))
+        self.assertDistinct(chosen)
+
+    def test_no_exact_solution(self):
+        # Two songs would fit, but they're by the same artist, so the
+        # closest we can do is one.
+        songs = {1: [Song(1, 200, [1]), Song(2, 200, [1])]}
+        result = fill_gap(repeating([1]), songs.get, timedelta(0, 400), timedelta(0, 5))
+        self.assertIsNotNone(result)
+        chosen, slots_used, distance = result
+        self.assertEqual(len(chosen), 1)
+        self.assertEqual(distance, timedelta(0, -190))
+
+    def test_nothing_to_choose(self):
+        self.assertIsNone(fill_gap(repeating([1]), lambda category: [], timedelta(0, 400), timedelta(0, 5)))
+
+    def test_deterministic(self):
+        songs = {1: [Song(n, 200 + n, [n]) for n in range(30)]}
+        results = [
+            [song.id for song, length in fill_gap(repeating([1]), songs.get, timedelta(0, 1000), timedelta(0, 2), seed=5)[0]]
+            for attempt in range(3)
+        ]
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
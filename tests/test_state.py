@@ -0,0 +1,98 @@
+import unittest
+
+from datetime import datetime, timedelta
+
+from automated.helpers.state import Checkpoints, SchedulerState
+
+
+START = datetime(2020, 1, 1, 12)
+
+
+def at(seconds):
+    return START + timedelta(0, seconds)
+
+
+def checkpoints_at(*times):
+    checkpoints = Checkpoints()
+    for n, seconds in enumerate(times):
+        state = SchedulerState(at(seconds), None, [])
+        state.last_queued = n
+        checkpoints.add(state)
+    return checkpoints
+
+
+class CheckpointsTest(unittest.TestCase):
+
+    def next_times(self, checkpoints):
+        return [state.next_time for state in checkpoints.states]
+
+    def test_restore_latest_before_cut(self):
+        checkpoints = checkpoints_at(0, 200, 400, 600)
+        restored = checkpoints.restore(at(500), at(0))
+        self.assertEqual(restored.next_time, at(400))
+        # The ones after it are forgotten.
+        self.assertEqual(self.next_times(checkpoints), [at(0), at(200), at(400)])
+
+    def test_restore_at_cut_time(self):
+        checkpoints = checkpoints_at(0, 200, 400)
+        self.assertEqual(checkpoints.restore(at(200), at(0)).next_time, at(200))
+
+    def test_restore_not_before_earliest(self):
+        # The cut is before anything which can still be re-planned, so
+        # planning goes back as far as it's allowed to.
+        checkpoints = checkpoints_at(0, 200, 400)
+        restored = checkpoints.restore(at(100), at(150))
+        self.assertEqual(restored.next_time, at(200))
+        self.assertEqual(self.next_times(checkpoints), [at(0), at(200)])
+
+    def test_restore_nothing_after_earliest(self):
+        checkpoints = checkpoints_at(0, 200)
+        self.assertIsNone(checkpoints.restore(at(300), at(250)))
+        self.assertEqual(self.next_times(checkpoints), [at(0), at(200)])
+
+    def test_restore_returns_a_copy(self):
+        checkpoints = checkpoints_at(0, 200)
+        restored = checkpoints.restore(at(200), at(0))
+        restored.sequence_items.append("item")
+        restored.planned_events[1] = (at(300), "signature")
+        self.assertEqual(checkpoints.states[-1].sequence_items, [])
+        self.assertEqual(checkpoints.states[-1].planned_events, {})
+
+    def test_trim(self):
+        checkpoints = checkpoints_at(0, 200, 400, 600)
+        for state in checkpoints.states:
+            state.planned_events = {1: (at(100), "a"), 2: (at(500), "b")}
+        checkpoints.trim(at(450))
+        # The last one before the cutoff is kept, to go back to.
+        self.assertEqual(self.next_times(checkpoints), [at(400), at(600)])
+        for state in checkpoints.states:
+            self.assertEqual(list(state.planned_events), [2])
+
+    def test_trim_keeps_one(self):
+        checkpoints = checkpoints_at(0, 200)
+        checkpoints.trim(at(1000))
+        self.assertEqual(self.next_times(checkpoints), [at(200)])
+
+    def test_restore_and_cut(self):
+        # Each step queues items from its checkpoint's next_time, numbered
+        # in the order they're queued. The event end marker at 200 belongs
+        # to the first step, and the song at 200 to the second.
+        queue = [(at(0), 1), (at(200), 2), (at(200), 3), (at(400), 4)]
+        checkpoints = Checkpoints()
+        for seconds, last_queued in ((0, 0), (200, 2), (400, 3), (600, 4)):
+            state = SchedulerState(at(seconds), None, [])
+            state.last_queued = last_queued
+            checkpoints.add(state)
+
+        restored = checkpoints.restore(at(250), at(0))
+        # The same rule as cut_queue: everything from next_time onwards
+        # which was queued after the checkpoint.
+        kept = [
+            (time, number) for time, number in queue
+            if time < restored.next_time or number <= restored.last_queued
+        ]
+        self.assertEqual(kept, [(at(0), 1), (at(200), 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()